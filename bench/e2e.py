@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+"""run peek.py end to end against local fake backends
+
+Every stage is a full run of peek.py in its own process so wall
+time, peak memory and the calls made against the fake servers
+belong to that stage alone.  The cold stage starts from empty task
+caches and the warm stage runs again on what the cold one stored.
+Each run's own metrics break its time down by report stage.
+"""
+import json
+import optparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+from pathlib import Path
+
+import fixtures
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINES = Path(__file__).resolve().parent / 'baselines.json'
+STAGES = ['cold', 'warm']
+
+
+def scenario_name(options):
+    """ name a scenario by what changes its results
+    :param options: optparse options
+    :return: str
+    """
+    return 'tasks={} projects={} users={} page={} latency={} workers={} cache={}'.format(
+        options.tasks,
+        options.projects,
+        options.users,
+        options.page_size,
+        options.latency,
+        options.workers,
+        'off' if options.no_cache else 'on',
+    )
+
+
+def run_peek(config, output, log):
+    """ run peek.py once
+    :param config: str of config path
+    :param output: str of path the report is written to
+    :param log: str of path peek's logging is written to
+    :return: dict of wall time in seconds and peak rss in kB
+    """
+    env = dict(os.environ)
+    # the fake servers speak plain http
+    env['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+    start = time.monotonic()
+    with open(output, 'w') as out, open(log, 'w') as err:
+        proc = subprocess.Popen(
+            [sys.executable, str(ROOT / 'peek.py'), '-c', config, '-p'],
+            cwd=str(ROOT),
+            env=env,
+            stdout=out,
+            stderr=err,
+        )
+        _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.monotonic() - start
+    if os.waitstatus_to_exitcode(status):
+        with open(log) as err:
+            sys.stderr.write(err.read()[-4000:])
+        raise Exception('peek.py failed with {}'.format(os.waitstatus_to_exitcode(status)))
+    # ru_maxrss is kB on linux and bytes on mac
+    rss = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    return {'wall': round(wall, 3), 'rss': rss}
+
+
+def run(options, workdir):
+    """ run every stage of a scenario
+    :param options: optparse options
+    :param workdir: str of directory for configs, caches and reports
+    :return: dict of stage to results
+    """
+    data = fixtures.dataset(
+        tasks=options.tasks,
+        projects_count=options.projects,
+        users_count=options.users,
+        seed=options.seed,
+    )
+    server = fixtures.FakeServer(data, latency=options.latency, page_size=options.page_size).start()
+
+    try:
+        cfg = fixtures.peek_config(data, server.url + '/api/', server.url + '/api/1.0')
+        cfg['templates'] = str(ROOT / 'templates')
+        cfg['metrics'] = {'json': os.path.join(workdir, 'metrics.json')}
+        cfg['backend_workers'] = options.workers
+        for be, beinfo in cfg['backends'].items():
+            beinfo['workers'] = options.workers
+            if not options.no_cache:
+                beinfo['cache'] = os.path.join(workdir, '{}.sqlite'.format(be))
+                beinfo['board_snapshot'] = True
+                beinfo['directory'] = os.path.join(workdir, 'directory.sqlite')
+
+        config = os.path.join(workdir, 'config.yml')
+        with open(config, 'w') as ymlfile:
+            yaml.safe_dump(cfg, ymlfile)
+
+        results = {}
+        for stage in STAGES:
+            server.reset()
+            results[stage] = run_peek(
+                config,
+                os.path.join(workdir, '{}.html'.format(stage)),
+                os.path.join(workdir, '{}.log'.format(stage)),
+            )
+            results[stage]['calls'] = server.reset()
+            with open(cfg['metrics']['json']) as f:
+                measured = json.load(f)
+            results[stage]['stages'] = dict((n, i['seconds']) for n, i in measured['stages'].items())
+        return results
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def regressions(results, baseline, tolerance):
+    """ compare results against a stored baseline
+    Call counts must not grow at all, wall time and memory may
+    grow by the tolerance before they count as a regression.
+    :param results: dict of stage to results
+    :param baseline: dict of stage to results
+    :param tolerance: float fraction
+    :return: list of str describing each regression
+    """
+    found = []
+    for stage, now in results.items():
+        then = baseline.get(stage)
+        if not then:
+            continue
+        for metric in ['wall', 'rss']:
+            if now[metric] > then[metric] * (1 + tolerance):
+                found.append('{} {}: {} > {}'.format(stage, metric, now[metric], then[metric]))
+        for endpoint, count in now['calls'].items():
+            if count > then['calls'].get(endpoint, 0):
+                found.append('{} {} calls: {} > {}'.format(stage, endpoint, count, then['calls'].get(endpoint, 0)))
+    return found
+
+
+def report(name, results):
+    print(name)
+    for stage, stats in results.items():
+        print('  {:<5} wall {:>8.3f}s  peak rss {:>8} kB  calls {:>5}'.format(
+            stage,
+            stats['wall'],
+            stats['rss'],
+            sum(stats['calls'].values()),
+        ))
+        for endpoint, count in sorted(stats['calls'].items()):
+            print('        {:<28} {:>5}'.format(endpoint, count))
+        for name, seconds in sorted(stats.get('stages', {}).items()):
+            print('        {:<28} {:>8.3f}s'.format(name, seconds))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--tasks', default=2000, type='int', help='phabricator tasks, asana gets half')
+    parser.add_option('--projects', default=3, type='int')
+    parser.add_option('--users', default=10, type='int')
+    parser.add_option('--page-size', default=100, dest='page_size', type='int', help='most results per page')
+    parser.add_option('--latency', default=0.0, type='float', help='seconds added to every response')
+    parser.add_option('--workers', default=1, type='int')
+    parser.add_option('--seed', default=1, type='int')
+    parser.add_option('--repeat', default=3, type='int', help='runs to take the quickest of')
+    parser.add_option('--no-cache', action='store_true', default=False, dest='no_cache')
+    parser.add_option('--baselines', default=str(BASELINES), type='str')
+    parser.add_option('--save-baseline', action='store_true', default=False, dest='save')
+    parser.add_option('--tolerance', default=.25, type='float', help='allowed wall time and memory growth')
+    parser.add_option('--json', default='', type='str', help='also write results to this file')
+    options, remainder = parser.parse_args()
+
+    name = scenario_name(options)
+    # the quickest of several runs is far less noisy than any one
+    results = {}
+    for attempt in range(max(1, options.repeat)):
+        with tempfile.TemporaryDirectory(prefix='peek-bench-') as workdir:
+            for stage, stats in run(options, workdir).items():
+                if stage in results and results[stage]['wall'] < stats['wall']:
+                    stats['wall'], stats['stages'] = results[stage]['wall'], results[stage]['stages']
+                if stage in results:
+                    stats['rss'] = min(stats['rss'], results[stage]['rss'])
+                results[stage] = stats
+    report(name, results)
+
+    if options.json:
+        with open(options.json, 'w') as out:
+            json.dump({name: results}, out, indent=2, sort_keys=True)
+
+    baselines = {}
+    if os.path.exists(options.baselines):
+        with open(options.baselines) as f:
+            baselines = json.load(f)
+
+    if options.save:
+        baselines[name] = results
+        with open(options.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('saved baseline to {}'.format(options.baselines))
+        return
+
+    if name not in baselines:
+        print('no baseline for this scenario, save one with --save-baseline')
+        return
+
+    found = regressions(results, baselines[name], options.tolerance)
+    for regression in found:
+        print('REGRESSION {}'.format(regression))
+    if found:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
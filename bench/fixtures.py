@@ -0,0 +1,426 @@
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+DAY = 86400
+COLUMNS = ['backlog', 'waiting', 'watching', 'progress']
+PRIORITIES = ['Unbreak Now!', 'High', 'Medium', 'Low', 'Lowest', 'Needs Triage']
+
+
+def asana_date(epoch, ms=0):
+    """ format an epoch the way the asana api does
+    :param epoch: int
+    :param ms: int of milliseconds
+    :return: str
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(epoch)) + '.{:03d}Z'.format(ms)
+
+
+def users(count):
+    """ the same people in both backends
+    :param count: int
+    :return: tuple of (phab user list, asana user list)
+    """
+    phab_users = []
+    asana_users = []
+    for i in range(count):
+        phab_users.append({
+            'phid': 'PHID-USER-{}'.format(i),
+            'userName': 'user{}'.format(i),
+            'realName': 'User {}'.format(i),
+            'image': 'https://phab.local/file/user{}.png'.format(i),
+            'uri': 'https://phab.local/p/user{}/'.format(i),
+            'roles': ['verified', 'approved', 'activated'],
+        })
+        asana_users.append({
+            'gid': str(1000 + i),
+            'name': 'Asana User {}'.format(i),
+            'resource_type': 'user',
+        })
+    return phab_users, asana_users
+
+
+def projects(count):
+    """ the same projects in both backends
+    :param count: int
+    :return: tuple of (phab projects by name, asana projects by name)
+    """
+    phab_projects = {}
+    asana_projects = {}
+    for i in range(count):
+        name = 'Project {}'.format(i)
+        phab_projects[name] = {
+            'phid': 'PHID-PROJ-{}'.format(i),
+            'name': name,
+            'columns': dict((c, 'PHID-PCOL-{}-{}'.format(i, c)) for c in COLUMNS),
+        }
+        asana_projects[name] = {
+            'gid': str(5000 + i),
+            'name': name,
+            'resource_type': 'project',
+        }
+    return phab_projects, asana_projects
+
+
+def phab_tasks(count, phab_projects, phab_users, rand, now, days=400):
+    """ generate maniphest.search results with every attachment
+    :param count: int
+    :param phab_projects: dict as returned by projects
+    :param phab_users: list as returned by users
+    :param rand: random.Random
+    :param now: epoch the data is relative to
+    :param days: int of days creation times are spread over
+    :return: generator of task dicts oldest first
+    """
+    names = sorted(phab_projects)
+    owners = [None] + [u['phid'] for u in phab_users]
+    for i in range(count):
+        project = phab_projects[names[rand.randrange(len(names))]]
+        column = project['columns'][rand.choice(COLUMNS)]
+        created = now - rand.randrange(days * DAY)
+        modified = min(now, created + rand.randrange(60 * DAY))
+        status = rand.choice([('open', 'Open')] * 3 + [('resolved', 'Resolved'), ('declined', 'Declined')])
+        tags = [project['phid']]
+        if rand.random() < .2:
+            tags.append('PHID-PROJ-OTHER')
+        yield {
+            'id': i + 1,
+            'phid': 'PHID-TASK-{}'.format(i + 1),
+            'type': 'TASK',
+            'fields': {
+                'name': 'Phabricator task {}'.format(i + 1),
+                'ownerPHID': rand.choice(owners),
+                'status': {'value': status[0], 'name': status[1]},
+                'priority': {'value': 50, 'name': rand.choice(PRIORITIES)},
+                'subtype': rand.choice(['default'] * 4 + ['security']),
+                'dateCreated': created,
+                'dateModified': modified,
+            },
+            'attachments': {
+                'projects': {'projectPHIDs': tags},
+                'columns': {'boards': {project['phid']: {'columns': [{'phid': column}]}}},
+            },
+        }
+
+
+def asana_tasks(count, asana_projects, asana_users, rand, now, days=400):
+    """ generate asana task results with peek's task fields
+    :param count: int
+    :param asana_projects: dict as returned by projects
+    :param asana_users: list as returned by users
+    :param rand: random.Random
+    :param now: epoch the data is relative to
+    :param days: int of days creation times are spread over
+    :return: generator of task dicts
+    """
+    assignees = [None] + asana_users
+    project_list = list(asana_projects.values())
+    for i in range(count):
+        project = rand.choice(project_list)
+        created = now - rand.randrange(days * DAY)
+        modified = min(now, created + rand.randrange(60 * DAY))
+        assignee = rand.choice(assignees)
+        completed = rand.random() < .4
+        name = 'Asana task {}'.format(i)
+        if rand.random() < .05:
+            name += ' [ignore]'
+        yield {
+            'gid': str(100000 + i),
+            'name': name,
+            'projects': [{'gid': project['gid'], 'resource_type': 'project'}],
+            'created_at': asana_date(created, rand.randrange(1000)),
+            'modified_at': asana_date(modified, rand.randrange(1000)),
+            'completed': completed,
+            'assignee': {'gid': assignee['gid'], 'resource_type': 'user'} if assignee else None,
+            'assignee_status': 'upcoming',
+        }
+
+
+def dataset(tasks=1000, projects_count=3, users_count=10, asana_count=None, days=400, seed=1, now=None):
+    """ generate phabricator and asana fixtures
+    Tasks are spread over projects, workboard columns, owners,
+    statuses and priorities with creation times reaching back
+    over days so every history duration has something to count.
+    :param tasks: int of phabricator tasks
+    :param projects_count: int of projects in each backend
+    :param users_count: int of users present in both backends
+    :param asana_count: int of asana tasks, half of tasks when None
+    :param days: int of days creation times are spread over
+    :param seed: int so the same arguments give the same data
+    :param now: epoch the data is relative to
+    :return: dict
+    """
+    now = int(now or time.time())
+    rand = random.Random(seed)
+    if asana_count is None:
+        asana_count = tasks // 2
+
+    phab_users, asana_users = users(users_count)
+    phab_projects, asana_projects = projects(projects_count)
+    phab_list = list(phab_tasks(tasks, phab_projects, phab_users, rand, now, days))
+    asana_list = list(asana_tasks(asana_count, asana_projects, asana_users, rand, now, days))
+
+    return {
+        'now': now,
+        'phab': {
+            'users': phab_users,
+            'projects': phab_projects,
+            # conduit orders newest first
+            'tasks': phab_list[::-1],
+        },
+        'asana': {
+            'workspace': {'gid': '1', 'name': 'Bench Workspace', 'resource_type': 'workspace'},
+            'users': asana_users,
+            'projects': asana_projects,
+            'tasks': asana_list,
+        },
+    }
+
+
+def peek_config(data, phab_host, asana_url, history=(1, 7, 30, 90, 365)):
+    """ a peek config reporting on everything in a dataset
+    :param data: dict as returned by dataset
+    :param phab_host: str of conduit api url
+    :param asana_url: str of asana api base url
+    :param history: list of int durations
+    :return: dict
+    """
+    users = {}
+    for phab, asana in zip(data['phab']['users'], data['asana']['users']):
+        users[phab['realName']] = {'phab': phab['userName'], 'asana': asana['name']}
+
+    return {
+        'job': 'Benchmark',
+        'history': list(history),
+        'summary_fields': ['status'],
+        'email': {'from': 'peek@bench.local', 'to': 'team@bench.local', 'server': '127.0.0.1'},
+        'sections': {
+            'summary': True,
+            'kanban': True,
+            'anti': True,
+            'users': True,
+            'tasks': True,
+            'tasks_breakdown': True,
+        },
+        'users': {
+            'attributes': {
+                'show': {
+                    'image': {'backend': 'phab', 'key': 'image'},
+                    'uri': {'backend': 'phab', 'key': 'uri'},
+                },
+            },
+            'map': users,
+            'anti': {
+                'moldy': {'name': 'Moldy', 'method': 'anti_moldy', 'age': 30 * DAY, 'show': 3},
+                'reporting': {
+                    'name': 'No reporting project',
+                    'method': 'anti_assigned_wo_reporting_project',
+                    'show': 3,
+                },
+            },
+        },
+        'backends': {
+            'asana': {
+                'enabled': True,
+                'token': 'bench',
+                'base_url': asana_url,
+                'workspace': data['asana']['workspace']['name'],
+                'ignore': ['[ignore]'],
+                'rate': 0,
+                'projects': dict(
+                    (name, {'columns': {'backlog': 'backlog', 'progress': 'progress'}})
+                    for name in data['asana']['projects']
+                ),
+            },
+            'phab': {
+                'enabled': True,
+                'host': phab_host,
+                'token': 'api-bench',
+                'timeout': 30,
+                'rate': 0,
+                'summary_fields': ['status', 'priority', 'issue type'],
+                'anti': {
+                    'punassigned': {'name': 'In progress unassigned', 'method': 'anti_punassigned'},
+                    'dormant': {'name': 'Watching dormant', 'method': 'anti_watching_dormant', 'age': 30 * DAY},
+                },
+                'projects': dict(
+                    (name, {'columns': dict(p['columns'])})
+                    for name, p in data['phab']['projects'].items()
+                ),
+            },
+        },
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    """just enough of conduit and the asana api to run peek"""
+
+    server_version = 'PeekBench/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def record(self, endpoint):
+        self.server.record(endpoint)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def conduit(self, result):
+        self.reply({'result': result, 'error_code': None, 'error_info': None})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode())
+        params = json.loads(form.get('params', ['{}'])[0])
+        method = self.path.rstrip('/').rsplit('/', 1)[-1]
+        self.record(method)
+
+        data = self.server.data['phab']
+        if method == 'maniphest.search':
+            return self.conduit(self.maniphest_search(data, params))
+        if method == 'user.query':
+            users = data['users']
+            if 'usernames' in params:
+                users = [u for u in users if u['userName'] in params['usernames']]
+            if 'phids' in params:
+                users = [u for u in users if u['phid'] in params['phids']]
+            return self.conduit(users)
+        if method == 'project.query':
+            names = params.get('names', [])
+            projects = dict(
+                (p['phid'], {'phid': p['phid'], 'name': p['name']})
+                for p in data['projects'].values() if p['name'] in names
+            )
+            return self.conduit({'data': projects, 'slugMap': {}, 'cursor': {}})
+        if method == 'user.whoami':
+            return self.conduit(data['users'][0])
+        self.reply({'result': None, 'error_code': 'ERR-CONDUIT-CALL', 'error_info': method})
+
+    def maniphest_search(self, data, params):
+        constraints = params.get('constraints') or {}
+        tasks = data['tasks']
+        if params.get('queryKey', 'open') == 'open':
+            tasks = [t for t in tasks if t['fields']['status']['value'] == 'open']
+        if 'projects' in constraints:
+            # projects may be named or given by phid
+            phids = set(data['projects'][p]['phid'] if p in data['projects'] else p for p in constraints['projects'])
+            tasks = [t for t in tasks if phids.intersection(t['attachments']['projects']['projectPHIDs'])]
+        if 'createdStart' in constraints:
+            tasks = [t for t in tasks if t['fields']['dateCreated'] >= constraints['createdStart']]
+        if 'modifiedStart' in constraints:
+            tasks = [t for t in tasks if t['fields']['dateModified'] >= constraints['modifiedStart']]
+        if 'columnPHIDs' in constraints:
+            columns = set(constraints['columnPHIDs'])
+            tasks = [
+                t for t in tasks
+                if any(c['phid'] in columns
+                       for b in t['attachments']['columns']['boards'].values()
+                       for c in b['columns'])
+            ]
+        if 'assigned' in constraints:
+            owners = set(constraints['assigned'])
+            tasks = [t for t in tasks if t['fields']['ownerPHID'] in owners]
+
+        start = int(params.get('after') or 0)
+        limit = min(int(params.get('limit') or 100), self.server.page_size)
+        attachments = params.get('attachments') or {}
+        page = []
+        for task in tasks[start:start + limit]:
+            task = dict(task)
+            task['attachments'] = dict((k, v) for k, v in task['attachments'].items() if attachments.get(k))
+            page.append(task)
+        after = str(start + limit) if start + limit < len(tasks) else None
+        return {
+            'data': page,
+            'maps': {},
+            'query': {'queryKey': params.get('queryKey')},
+            'cursor': {'limit': limit, 'after': after, 'before': None, 'order': params.get('order')},
+        }
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        path = url.path[len('/api/1.0'):]
+        self.record('GET ' + re.sub(r'/\d+', '/:gid', path))
+
+        data = self.server.data['asana']
+        if path == '/workspaces':
+            return self.collection(path, query, [data['workspace']])
+        if path == '/projects':
+            return self.collection(path, query, list(data['projects'].values()))
+        if re.match(r'/workspaces/\d+/users$', path):
+            return self.collection(path, query, data['users'])
+        match = re.match(r'/users/(\d+)$', path)
+        if match:
+            for user in data['users']:
+                if user['gid'] == match.group(1):
+                    return self.reply({'data': user})
+        if path == '/tasks':
+            tasks = data['tasks']
+            if 'project' in query:
+                tasks = [t for t in tasks if t['projects'][0]['gid'] == query['project'][0]]
+            if 'modified_since' in query:
+                since = query['modified_since'][0]
+                tasks = [t for t in tasks if t['modified_at'] >= since]
+            return self.collection(path, query, tasks)
+        self.reply({'errors': [{'message': 'Not found'}]}, 404)
+
+    def collection(self, path, query, items):
+        offset = int(query.get('offset', ['0'])[0])
+        limit = min(int(query.get('limit', ['50'])[0]), self.server.page_size)
+        next_page = None
+        if offset + limit < len(items):
+            next_page = {'offset': str(offset + limit), 'path': path, 'uri': ''}
+        self.reply({'data': items[offset:offset + limit], 'next_page': next_page})
+
+
+class FakeServer(ThreadingHTTPServer):
+    """local stand in for both backends counting every call"""
+
+    daemon_threads = True
+
+    def __init__(self, data, latency=0, page_size=100):
+        """
+        :param data: dict as returned by dataset
+        :param latency: float of seconds added to every response
+        :param page_size: int of the most results a page may hold
+        """
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.data = data
+        self.latency = latency
+        self.page_size = page_size
+        self.counts = {}
+        self.counts_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def record(self, endpoint):
+        with self.counts_lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+    def reset(self):
+        """ get and clear the call counts
+        :return: dict of endpoint to int
+        """
+        with self.counts_lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
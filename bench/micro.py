@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+"""time the in process steps of a report on generated data
+
+The backends answer from generated tasks instead of the network
+so every step after the fetch can be timed on its own at sizes
+well past what the fake servers can serve: record conversion,
+duration summaries, summary tables, task store merging, the
+antipatterns, each backend end to end and the final render.
+"""
+import itertools
+import json
+import logging
+import optparse
+import random
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import fixtures
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import peek  # noqa: E402
+from plib import asanaapi  # noqa: E402
+from plib import phabapi  # noqa: E402
+from plib import taskstore  # noqa: E402
+from plib import timeindex  # noqa: E402
+from plib import view  # noqa: E402
+
+HISTORY = [1, 7, 30, 90, 365]
+
+
+class LocalPhab(phabapi.Status):
+    """phab backend answering from generated tasks instead of conduit"""
+    def __init__(self, tasks, phab_projects, phab_users):
+        super().__init__(host='', token='', timeout=0, board_snapshot=True)
+        self.logger = logging
+        self.users = phab_users
+        names = dict((p['phid'], name) for name, p in phab_projects.items())
+        by_project = dict((name, []) for name in phab_projects)
+        for task in tasks:
+            by_project[names[task.projects[0]]].append(task)
+        for project, ptasks in by_project.items():
+            self.task_history[project] = {'start_date': 0, 'tasks': timeindex.TimeIndex(ptasks)}
+            self.boards[project] = [t for t in ptasks if t.status == 'open']
+        key = json.dumps(sorted(phab_projects))
+        self.project_details = {key: {'data': dict((p['phid'], p) for p in phab_projects.values())}}
+
+    def get_members_info(self, usernames, agents=False, batch=100):
+        found = dict((u['userName'], u) for u in self.users)
+        return dict((r, found[u]) for r, u in usernames.items())
+
+    def users_assigned(self, users_details, projects=None):
+        assigned = dict((u['phid'], []) for u in users_details)
+        for board in self.boards.values():
+            for task in board:
+                if task.owner in assigned:
+                    assigned[task.owner].append(task)
+        return [assigned[u['phid']] for u in users_details]
+
+
+class LocalAsana(asanaapi.Status):
+    """asana backend answering from generated tasks instead of the api"""
+    def __init__(self, tasks, asana_projects, asana_users):
+        super().__init__(token='', ignore=['[ignore]'])
+        self.logger = logging
+        self.users = asana_users
+        self.projects = asana_projects
+        self.workspace_projects = list(asana_projects.values())
+        names = dict((p['gid'], name) for name, p in asana_projects.items())
+        by_project = dict((name, []) for name in asana_projects)
+        for task in tasks:
+            by_project[names[task.projects[0]]].append(task)
+        for project, ptasks in by_project.items():
+            self.set_history(project, 0, timeindex.TimeIndex(ptasks))
+
+    def get_members_info(self, usernames, agents=False):
+        found = dict((u['name'], u) for u in self.users)
+        return dict((r, found[u]) for r, u in usernames.items())
+
+
+def ingest(convert, raw, chunk=50000):
+    """ convert generated results a chunk at a time
+    Only the conversion is timed and raw results never pile up
+    so large sizes are not limited by fixture memory.
+    :param convert: callable turning a raw result into a Task
+    :param raw: iterable of raw results
+    :return: tuple of (task list, seconds spent converting)
+    """
+    tasks = []
+    spent = 0
+    raw = iter(raw)
+    while True:
+        batch = list(itertools.islice(raw, chunk))
+        if not batch:
+            return tasks, round(spent, 4)
+        start = time.perf_counter()
+        tasks += map(convert, batch)
+        spent += time.perf_counter() - start
+
+
+def timed(results, name, function, *args):
+    """ time a step and keep its result
+    :param results: dict of step name to seconds
+    :return: result of function
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    results[name] = round(time.perf_counter() - start, 4)
+    return result
+
+
+def run(size, options):
+    """ time every step for one dataset size
+    :param size: int of phabricator tasks
+    :param options: optparse options
+    :return: dict of step name to seconds
+    """
+    now = int(time.time())
+    rand = random.Random(options.seed)
+    data = fixtures.dataset(tasks=0, projects_count=options.projects, users_count=options.users, now=now)
+    cfg = fixtures.peek_config(data, '', '', history=HISTORY)
+    cfg['templates'] = str(ROOT / 'templates')
+    phab, asana = data['phab'], data['asana']
+
+    results = {}
+    phab_tasks, results['ingest phab'] = ingest(
+        phabapi.Status(host='', token='', timeout=0).to_task,
+        fixtures.phab_tasks(size, phab['projects'], phab['users'], rand, now)
+    )
+    asana_tasks, results['ingest asana'] = ingest(
+        asanaapi.Status(token='').to_task,
+        fixtures.asana_tasks(size // 2, asana['projects'], asana['users'], rand, now)
+    )
+
+    wobjs = {
+        'phab': LocalPhab(phab_tasks, phab['projects'], phab['users']),
+        'asana': LocalAsana(asana_tasks, asana['projects'], asana['users']),
+    }
+
+    def summaries():
+        for be, wobj in wobjs.items():
+            fields = cfg['backends'][be].get('summary_fields', cfg['summary_fields'])
+            for project, history in wobj.task_history.items():
+                tasks = wobj.get_tasks_created_since(project, max(HISTORY))
+                windows = dict((d, len(wobj.get_tasks_created_since(project, d))) for d in HISTORY)
+                wobj.tasks_summaries(tasks, windows, fields)
+    timed(results, 'summaries', summaries)
+
+    # the boards and assignments the rules read, as process_backend has them
+    rule_inputs = {}
+    for be, wobj in wobjs.items():
+        beinfo = cfg['backends'][be]
+        projects = dict(
+            (project, {'columns': dict((c, wobj.column_tasks(id, project)) for c, id in pcfg['columns'].items())})
+            for project, pcfg in beinfo['projects'].items()
+        )
+        details = wobj.get_members_info(dict((u, names[be]) for u, names in cfg['users']['map'].items()))
+        assigned = dict(zip(details, wobj.users_assigned(list(details.values()))))
+        rule_inputs[be] = (projects, details, assigned)
+
+    def antipatterns():
+        for be, wobj in wobjs.items():
+            peek.find_antipatterns(wobj, cfg['backends'][be], cfg, *rule_inputs[be])
+    timed(results, 'antipatterns', antipatterns)
+
+    processed = {}
+    for be, wobj in wobjs.items():
+        processed[be] = timed(results, 'process {}'.format(be), peek.process_backend, wobj, be, cfg['backends'][be], cfg)
+
+    meta = {'starttime': time.time(), 'enabled_projects': [], 'enabled_backends': sorted(wobjs, reverse=True)}
+    total = {
+        'max': max(HISTORY),
+        'columns': {},
+        'projects': {},
+        'users': {'group': {'assigned': {}}, 'individual': {}},
+        'anti': {},
+    }
+    bes = {}
+
+    def merge():
+        store = taskstore.TaskStore()
+        for be in meta['enabled_backends']:
+            bes[be] = peek.merge_backend(total, store, meta, be, cfg['backends'][be], cfg, processed[be])
+        peek.resolve_totals(total, store)
+    timed(results, 'merge', merge)
+    timed(results, 'summary tables', peek.summary_tables, total, bes, cfg)
+
+    meta['runtime'] = 0
+    meta['name'] = 'peek'
+    model = timed(results, 'view model', view.build, meta, bes, cfg, total)
+
+    def render():
+        # the report streams out a piece at a time, count it the same way
+        return sum(len(chunk) for chunk in view.render(cfg, model, now=int(time.time())))
+    results['report bytes'] = timed(results, 'render', render)
+    return results
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--sizes', default='10000,100000,500000', type='str', help='comma separated phabricator task counts')
+    parser.add_option('--projects', default=20, type='int')
+    parser.add_option('--users', default=200, type='int')
+    parser.add_option('--seed', default=1, type='int')
+    parser.add_option('--record', default='', type='str', help='append results as a json line to this file')
+    options, remainder = parser.parse_args()
+
+    # peek logs every user at info, keep the timings readable
+    logging.basicConfig(level=logging.WARNING)
+
+    sizes = [int(s) for s in options.sizes.split(',') if s]
+    runs = {}
+    for size in sizes:
+        runs[size] = run(size, options)
+
+    steps = list(runs[sizes[0]].keys())
+    print('{:<16}'.format('tasks') + ''.join('{:>12}'.format(s) for s in sizes))
+    for step in steps:
+        print('{:<16}'.format(step) + ''.join('{:>12}'.format(runs[s][step]) for s in sizes))
+
+    if options.record:
+        try:
+            commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(ROOT)).decode().strip()
+        except Exception:
+            commit = None
+        with open(options.record, 'a') as out:
+            out.write(json.dumps({
+                'time': int(time.time()),
+                'commit': commit,
+                'projects': options.projects,
+                'users': options.users,
+                'runs': runs,
+            }, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
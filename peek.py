@@ -1,19 +1,29 @@
 #!/usr/bin/python3
 import copy
 import datetime
+import html
+import importlib
+import http.server
+import json
 import logging
 import optparse
+import os
 import sys
+import threading
 import time
+import urllib.parse
 import yaml
-from collections import Counter
-from jinja2 import Environment
-from jinja2 import FileSystemLoader
 from pathlib import Path
 from plib import util
-from plib import phabapi
-from plib import asanaapi
 from plib import format
+from plib import metrics
+from plib import profiling
+from plib import rules
+from plib import schedule
+from plib import stats
+from plib import tape
+from plib import taskstore
+from plib import view
 
 
 def getname():
@@ -22,11 +32,13 @@ def getname():
 
 
 def get_wclass(backend):
-    backend_classes = {
-        'asana': asanaapi,
-        'phab': phabapi,
+    # imported on first use so a disabled backend's client library
+    # is never loaded
+    backend_modules = {
+        'asana': 'plib.asanaapi',
+        'phab': 'plib.phabapi',
     }
-    return backend_classes[backend]
+    return importlib.import_module(backend_modules[backend])
 
 
 def get_wobj(backend, config):
@@ -39,45 +51,446 @@ def get_wobj(backend, config):
         sys.exit(1)
 
 
-def main():
+def process_backend(wobj, be, beinfo, cfg):
+    """ fetch and aggregate a single backend
+    :param wobj: backend Status object
+    :param be: str of backend name
+    :param beinfo: dict of backend config
+    :param cfg: dict of full config
+    :return: tuple of backend results and antipattern matches
+    """
+    wobj.logger = logging
+
+    # Calls within a backend are independent of each other so they
+    # share a bounded pool and are gathered back in config order.
+    workers = beinfo.get('workers', 1)
+    summary_fields = beinfo.get('summary_fields', cfg['summary_fields'])
+
+    # Projects
+    def project_history(project):
+        logging.info('Processing {} project {}'.format(be, project))
+
+        with metrics.stage('{}/fetch/{}'.format(be, project)):
+            history = {}
+            windows = {}
+            for duration in sorted(cfg['history'], reverse=True):
 
-    parser = optparse.OptionParser()
-    parser.add_option('-c', '--config', default='config.yml', dest="config", type="str")
-    parser.add_option('-j', '--job', default='', dest="job", type="str")
-    parser.add_option('-p', action='store_true', default=False, dest='echo')
-    parser.add_option('-s', action='store_true', default=False, dest='send')
-    parser.add_option('-v', action='store_true', default=False, dest='verbose')
+                tasks = wobj.get_tasks_created_since(project, duration)
+                logging.debug("{}: {} duration at task count {}".format(project, duration, len(tasks)))
 
-    options, remainder = parser.parse_args()
+                history[duration] = {}
+                history[duration]['tasks'] = tasks
+                windows[duration] = len(tasks)
+
+            # Shorter durations are the newest tasks of the longest one
+            # so every duration is counted in a single walk over it.
+            widest = history[max(cfg['history'])]['tasks']
+            for duration, counts in wobj.tasks_summaries(widest, windows, summary_fields).items():
+                history[duration]['stats'] = counts
+        return history
+
+    projects = {}
+    project_names = sorted(beinfo['projects'].keys())
+    for project, history in zip(project_names, util.pmap(project_history, project_names, workers)):
+        projects[project] = {}
+        projects[project]['history'] = history
+        projects[project]['show'] = {}
+
+    for project, pinfo in projects.items():
+        projects[project]['show']['uri'] = wobj.generate_project_link(project)
+
+    # Columns
+    board = []
+    for project, pinfo in beinfo['projects'].items():
+        projects[project]['columns'] = {}
+        for column, id in beinfo['projects'][project]['columns'].items():
+            board.append((project, column, id))
+
+    with metrics.stage('{}/columns'.format(be)):
+        board_tasks = util.pmap(lambda c: wobj.column_tasks(c[2], c[0]), board, workers)
+        for (project, column, id), ctasks in zip(board, board_tasks):
+            logging.debug('Get {} id {} for {}: {}'.format(column, id, project, len(ctasks)))
+            projects[project]['columns'][column] = ctasks
+
+    result = {}
+    result['projects'] = projects
+    # Users
+    report_users = cfg['users']['map']
+    user_names = list(report_users.keys())
+
+    # One lookup for every mapped user and one paged search for
+    # all of their assigned tasks, split back out per user.
+    with metrics.stage('{}/users'.format(be)):
+        details = wobj.get_members_info(dict((u, report_users[u][be]) for u in user_names))
+        logging.debug('{} member details'.format(be))
+        user_tasks = wobj.users_assigned([details[u] for u in user_names], beinfo['projects'])
+
+    with metrics.stage('{}/antipatterns'.format(be)):
+        anti_found, user_found = find_antipatterns(wobj, beinfo, cfg, projects, details, dict(zip(user_names, user_tasks)))
+
+    def user_stats(u, assigned):
+        uinfo = {}
+        uinfo['details'] = details[u]
+
+        for sa, sa_info in cfg['users']['attributes']['show'].items():
+            sa_backend = sa_info['backend']
+            sa_key = sa_info['key']
+            if be == sa_backend:
+                uinfo[sa_key] = uinfo['details'][sa]
+
+        uinfo['stats'] = {}
+        uinfo['stats']['assigned'] = assigned
+
+        if 'anti' in cfg['users']:
+
+            uinfo['antipatterns'] = {}
+            for rule, anti_result in user_found[u]:
+                logging.debug("{} {} {}".format(u, rule.name, len(anti_result)))
+                if not anti_result:
+                    continue
+
+                if rule.name not in uinfo['antipatterns']:
+                    uinfo['antipatterns'][rule.name] = {}
+                uinfo['antipatterns'][rule.name]['all'] = anti_result
+                logging.info('{} {} assigned {} {} {}'.format(u, be, len(assigned), rule.name, len(anti_result)))
+
+                uinfo['antipatterns'][rule.name]['shown'] = []
+                m_shown = uinfo['antipatterns'][rule.name]['all'][:rule.show]
+                for task in m_shown:
+                    uinfo['antipatterns'][rule.name]['shown'].append(wobj.generate_task_link(task))
+        return uinfo
+
+    users = {}
+    for u, assigned in zip(user_names, user_tasks):
+        users[u] = user_stats(u, assigned)
+
+    result['users'] = users
+    return result, anti_found
+
+
+def find_antipatterns(wobj, beinfo, cfg, projects, details, assigned):
+    """ evaluate the project and user antipatterns of a backend together
+    :param wobj: backend Status object
+    :param beinfo: dict of backend config
+    :param cfg: dict of full config
+    :param projects: dict of project results with their columns
+    :param details: dict of user to backend user details
+    :param assigned: dict of user to assigned task list
+    :return: tuple of list of (name, task list) per project and rule
+             and dict of user to list of (Rule, task list)
+    """
+    project_rules = rules.load(beinfo.get('anti', {}))
+    user_rules = rules.load(cfg['users'].get('anti', {}))
+    context = {
+        'now': time.time(),
+        'owners': dict((wobj.user_key(d), u) for u, d in details.items() if d),
+        'tags': {},
+        'reporting': set(),
+    }
+    if any(rule.needs_projects() for rule in project_rules + user_rules):
+        # one lookup covers the backend's projects and any rule names
+        names = set(beinfo['projects']).union(*(rule.tag_names() for rule in project_rules + user_rules))
+        context['tags'] = wobj.project_keys(sorted(names))
+        context['reporting'] = set(context['tags'][p.lower()] for p in beinfo['projects'] if p.lower() in context['tags'])
+
+    found, user_found = rules.evaluate(project_rules, user_rules, projects, assigned, context)
+    anti_found = []
+    for project, rule, anti_result in found:
+        if anti_result:
+            logging.info("{} anti found count {}".format(project, len(anti_result)))
+        anti_found.append((rule.name, anti_result))
+    return anti_found, user_found
+
+
+def merge_backend(total, store, meta, be, beinfo, cfg, processed):
+    """ fold the results of process_backend into the report totals
+    :param total: dict of report totals
+    :param store: TaskStore holding the tasks behind id sets in total
+    :param meta: dict of report metadata
+    :param be: str of backend name
+    :param beinfo: dict of backend config
+    :param cfg: dict of full config
+    :param processed: tuple as returned by process_backend
+    :return: dict of backend results
+    """
+    result, anti_found = processed
+    projects = result['projects']
+
+    for project, pinfo in projects.items():
+        meta['enabled_projects'].append(project)
+
+    for project, pinfo in projects.items():
+        for column, ctasks in pinfo['columns'].items():
+            if column not in total['columns']:
+                total['columns'][column] = {}
+            total['columns'][column].update(store.add(ctasks))
+
+    if 'anti' in beinfo:
+        if 'total' not in total['anti']:
+            total['anti']['total'] = 0
+        if 'patterns' not in total['anti']:
+            total['anti']['patterns'] = {}
+        for name, anti_result in anti_found:
+            if name not in total['anti']['patterns']:
+                total['anti']['patterns'][name] = {}
+            total['anti']['patterns'][name].update(store.add(anti_result))
+
+        # Create total out of deduped list counts
+        for pattern, matches in total['anti']['patterns'].items():
+            total['anti']['total'] += len(matches)
+
+    users = result['users']
+    if 'count' not in total['users']:
+        total['users']['group']['count'] = len(cfg['users']['map'])
+
+    for u, uinfo in users.items():
+        assigned = store.add(uinfo['stats']['assigned'])
+
+        if u not in total['users']['individual']:
+            total['users']['individual'][u] = {}
+
+        total['users']['group']['assigned'].update(assigned)
+
+        if 'stats' not in total['users']['individual'][u]:
+            total['users']['individual'][u]['stats'] = {}
+
+        if 'assigned' not in total['users']['individual'][u]['stats']:
+            total['users']['individual'][u]['stats']['assigned'] = {}
+
+        total['users']['individual'][u]['stats']['assigned'].update(assigned)
+
+        if 'anti' in cfg['users']:
+
+            if 'antipatterns' not in total['users']['individual'][u]['stats']:
+                total['users']['individual'][u]['stats']['antipatterns'] = []
+
+            if 'antipatterns' not in total['users']['group']:
+                total['users']['group']['antipatterns'] = []
+
+            for name, groups in uinfo['antipatterns'].items():
+                total['users']['individual'][u]['stats']['antipatterns'] += groups['all']
+                total['users']['group']['antipatterns'] += groups['all']
+
+    return result
+
+
+def resolve_totals(total, store):
+    """ swap the id sets in the report totals for their tasks
+    :param total: dict of report totals
+    :param store: TaskStore the id sets were handed out by
+    """
+    for column, ids in total['columns'].items():
+        total['columns'][column] = store.get(ids)
+
+    for pattern, ids in total['anti'].get('patterns', {}).items():
+        total['anti']['patterns'][pattern] = store.get(ids)
+
+    total['users']['group']['assigned'] = store.get(total['users']['group']['assigned'])
+    for u, uinfo in total['users']['individual'].items():
+        uinfo['stats']['assigned'] = store.get(uinfo['stats']['assigned'])
+
+
+def summary_tables(total, bes, cfg):
+    """ build every summary table from one matrix of project stats
+    Project tables share the columns of their backend and the totals
+    table is the sum over every project.
+    :param total: dict of report totals
+    :param bes: dict of backend results
+    :param cfg: dict of full config
+    """
+    matrix = stats.SummaryMatrix(cfg['history'])
+    for be, result in bes.items():
+        for project, pinfo in result.get('projects', {}).items():
+            matrix.add((be, project), pinfo['history'])
+
+    for be, result in bes.items():
+        projects = result.get('projects', {})
+        keys = [(be, project) for project in projects]
+        header = format.tasks_summary_header(matrix, keys)
+        for project, pinfo in projects.items():
+            pinfo['history']['summary_table'] = format.tasks_summary_table(matrix, header, [(be, project)])
 
-    logging.basicConfig(
-        level=logging.DEBUG if options.verbose else logging.INFO,
-        format="%(asctime)s:%(levelname)s:%(message)s"
-    )
-    logging.debug(options)
+    total['summary_header'] = format.tasks_summary_header(matrix)
+    total['projects']['history'] = {}
+    total['projects']['history']['summary_table'] = format.tasks_summary_table(matrix, total['summary_header'])
+
+
+def export_metrics(cfg, meta):
+    """ write run measurements wherever the config asks for them
+    :param cfg: dict of full config
+    :param meta: dict of report metadata
+    """
+    mcfg = cfg.get('metrics', {})
+    runtime = round(time.time() - meta['starttime'], 3)
+    if mcfg.get('json'):
+        metrics.write_json(mcfg['json'], cfg['job'], {'runtime': runtime})
+    if mcfg.get('prometheus'):
+        metrics.write_prometheus(mcfg['prometheus'], cfg['job'], {
+            'peek_runtime_seconds': runtime,
+            'peek_last_run_timestamp_seconds': int(time.time()),
+        })
 
-    def loadconfig(configs):
+
+# libyaml's parser when PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# merged configs by the files they were read from and when those changed
+loaded_configs = {}
+
+
+def mtime(path):
+    """ when a file last changed
+    :param path: str
+    :return: int of nanoseconds or None when it cannot be read
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def loadconfig(configs, strict=False):
+    """ read comma separated config files over each other
+    Files are only parsed again once one of them has changed, so
+    every job of a batch or daemon refresh shares the work.
+    :param configs: str of config paths
+    :param strict: bool to raise when any file cannot be read
+                   rather than merging the rest
+    :return: dict of merged config, a copy the caller may change
+    """
+    paths = [c for c in configs.split(',') if c]
+    key = tuple((c, mtime(c)) for c in paths)
+    if key not in loaded_configs:
+        # older versions of the same files are never asked for again
+        for stale in [k for k in loaded_configs if [c for c, _ in k] == paths]:
+            del loaded_configs[stale]
         out = {}
-        for c in configs.split(','):
-            if not c:
-                continue
+        failed = []
+        for c in paths:
             try:
                 with open(c, 'r') as ymlfile:
-                    v = yaml.load(ymlfile)
+                    v = yaml.load(ymlfile, Loader=YAML_LOADER)
                     logging.debug(v)
                     out.update(v)
             except Exception:
                 logging.critical('failed to read config file {}'.format(c))
-        return out
-
-    cfg = loadconfig(options.config)
+                failed.append(c)
+        loaded_configs[key] = (out, failed)
+    out, failed = loaded_configs[key]
+    if strict and failed:
+        raise Exception('failed to read config files {}'.format(', '.join(failed)))
+    return copy.deepcopy(out)
+
+
+def load_job(configs, job, options, strict=False):
+    """ load the config of one report and apply command line options
+    :param configs: str of config paths
+    :param job: str of job name overriding the config or ''
+    :param options: optparse options
+    :param strict: bool to raise on a bad config rather than exit,
+                   for a running daemon that has to keep going
+    :return: dict of full config
+    """
+    with metrics.stage('config'):
+        cfg = loadconfig(configs, strict)
     if not cfg:
-        sys.exit(1)
-        raise Exception('Failure to gather configuration from {}'.format(options.config))
-
-    if options.job:
-        logging.debug("Overriding job name to: {}".format(options.job))
-        cfg['job'] = options.job
+        if not strict:
+            sys.exit(1)
+        raise Exception('Failure to gather configuration from {}'.format(configs))
+
+    if job:
+        logging.debug("Overriding job name to: {}".format(job))
+        cfg['job'] = job
+
+    if options.refresh_directory:
+        for beinfo in cfg['backends'].values():
+            beinfo['directory_refresh'] = True
+
+    if options.record or options.replay:
+        for beinfo in cfg['backends'].values():
+            beinfo['record'] = options.record
+            beinfo['replay'] = options.replay
+
+    if options.profile:
+        # work on other threads is invisible to the profiler
+        cfg['backend_workers'] = 1
+        for beinfo in cfg['backends'].values():
+            beinfo['workers'] = 1
+            beinfo['prefetch'] = False
+    return cfg
+
+
+# backend settings that shape a single report rather than what is fetched
+REPORT_SETTINGS = ('enabled', 'projects', 'anti', 'summary_fields', 'workers', 'directory_refresh')
+
+
+def backend_key(be, beinfo):
+    """ name the connection a backend config fetches through
+    :param be: str of backend name
+    :param beinfo: dict of backend config
+    :return: str equal for configs that can share one backend object
+    """
+    shared = dict((k, v) for k, v in beinfo.items() if k not in REPORT_SETTINGS)
+    return json.dumps([be, shared], sort_keys=True, default=str)
+
+
+def shared_backends(jobs, wobjs=None):
+    """ one backend object per connection holding what every job needs
+    Each backend is asked once for the union of the projects over the
+    widest history and the users of every job using it.  The objects
+    keep what they fetched so each report reads it back from memory.
+    :param jobs: list of full configs
+    :param wobjs: dict as returned before, refreshed rather than rebuilt
+    :return: dict of backend_key to backend Status object
+    """
+    wobjs = wobjs if wobjs is not None else {}
+    wanted = {}
+    for cfg in jobs:
+        for be, beinfo in cfg['backends'].items():
+            if not beinfo.get('enabled', False):
+                continue
+            want = wanted.setdefault(backend_key(be, beinfo), {
+                'be': be,
+                'beinfo': dict(beinfo, projects={}),
+                'history': 0,
+                'users': set(),
+            })
+            want['beinfo']['projects'].update(beinfo['projects'])
+            want['beinfo']['directory_refresh'] = want['beinfo'].get('directory_refresh') or beinfo.get('directory_refresh')
+            want['history'] = max(want['history'], max(cfg['history']))
+            want['users'].update(u[be] for u in cfg['users']['map'].values() if be in u)
+
+    for key, want in wanted.items():
+        be, beinfo = want['be'], want['beinfo']
+        with metrics.stage('{}/prefetch'.format(be)):
+            logging.info('Fetching {} projects and {} users from {} for every job'.format(
+                len(beinfo['projects']), len(want['users']), be))
+            if key in wobjs:
+                wobj = wobjs[key]
+                wobj.refresh()
+            else:
+                wobj = get_wobj(be, {'backends': {be: beinfo}})
+                wobj.logger = logging
+            workers = beinfo.get('workers', 1)
+            util.pmap(lambda p: wobj.get_tasks_created_since(p, want['history']), sorted(beinfo['projects']), workers)
+            details = wobj.get_members_info(dict((u, u) for u in sorted(want['users'])))
+            wobj.users_assigned(list(details.values()))
+        wobjs[key] = wobj
+    return wobjs
+
+
+def run_report(cfg, get_backend=None, echo=False, send=False, path=None, keep=False):
+    """ build a report and print, write, send and measure it as asked
+    :param cfg: dict of full config
+    :param get_backend: callable of backend name to Status object,
+                        by default a new one per backend
+    :param echo: bool to print the report
+    :param send: bool to email the report
+    :param path: str of file to write the report to
+    :param keep: bool to return the report
+    :return: str of the rendered report when sent or kept, else None
+    """
+    get_backend = get_backend or (lambda be: get_wobj(be, cfg))
 
     meta = {}
     meta['starttime'] = time.time()
@@ -88,16 +501,15 @@ def main():
     total['max'] = max(cfg['history'])
     total['columns'] = {}
     total['projects'] = {}
-    total['projects']['history'] = {}
     total['users'] = {}
     total['users']['group'] = {}
-    total['users']['group']['assigned'] = []
+    total['users']['group']['assigned'] = {}
     total['users']['individual'] = {}
-    total['summary_header'] = {}
 
     total['anti'] = {}
 
     bes = {}
+    enabled = []
     for be, beinfo in sorted(cfg['backends'].items(), reverse=True):
         bes[be] = {}
         logging.info('Processing backend: {}'.format(be))
@@ -107,199 +519,279 @@ def main():
             continue
 
         meta['enabled_backends'].append(be)
+        enabled.append(be)
 
-        wobj = get_wobj(be, cfg)
-        wobj.logger = logging
-
-        # Projects
-        projects = {}
-        for project in sorted(beinfo['projects'].keys()):
-            logging.info('Processing {} project {}'.format(be, project))
-            meta['enabled_projects'].append(project)
-
-            projects[project] = {}
-            projects[project]['history'] = {}
-            projects[project]['show'] = {}
-
-            for duration in sorted(cfg['history'], reverse=True):
-
-                tasks = wobj.get_tasks_created_since(project, duration)
-                logging.debug("{}: {} duration at task count {}".format(project, duration, len(tasks)))
-
-                summary_fields = cfg['backends'][be].get('summary_fields', cfg['summary_fields'])
-
-                stats = wobj.tasks_summary(tasks, summary_fields)
-
-                projects[project]['history'][duration] = {}
-                projects[project]['history'][duration]['tasks'] = tasks
-                projects[project]['history'][duration]['stats'] = stats
+    # Backends are independent until their results are folded into
+    # the totals, which is always done in the serial backend order.
+    def run_backend(be):
+        with metrics.stage(be):
+            return process_backend(get_backend(be), be, cfg['backends'][be], cfg)
 
-                if duration not in total['projects']['history']:
-                    total['projects']['history'][duration] = {}
-                    total['projects']['history'][duration]['stats'] = copy.deepcopy(stats)
+    processed = util.pmap(run_backend, enabled, workers=cfg.get('backend_workers', 1))
 
-                for field, values in stats.items():
-                    thisproj = stats[field]
-                    sofar = total['projects']['history'][duration]['stats'][field]
-                    new = Counter(thisproj) + Counter(sofar)
-                    total['projects']['history'][duration]['stats'][field] = dict(new)
+    with metrics.stage('merge'):
+        store = taskstore.TaskStore()
+        for be, result in zip(enabled, processed):
+            bes[be] = merge_backend(total, store, meta, be, cfg['backends'][be], cfg, result)
+        resolve_totals(total, store)
 
-        summary_header = {}
-        for project, pinfo in projects.items():
-            headers = format.tasks_summary_header(pinfo['history'])
-            for k, v in headers.items():
-                if k not in summary_header:
-                    summary_header[k] = v
-                else:
-                    summary_header[k] = list(set(summary_header[k] + v))
-
-                if k not in total['summary_header']:
-                    total['summary_header'][k] = v
-                else:
-                    total['summary_header'][k] = list(set(total['summary_header'][k] + v))
-
-        for project, pinfo in projects.items():
-            projects[project]['show']['uri'] = wobj.generate_project_link(project)
-            projects[project]['history']['summary_table'] = format.tasks_summary_table(summary_header, pinfo['history'])
-
-        # Columns
-        for project, pinfo in beinfo['projects'].items():
-            projects[project]['columns'] = {}
-            for column, id in beinfo['projects'][project]['columns'].items():
-                ctasks = wobj.column_tasks(id, project)
-                logging.debug('Get {} id {} for {}: {}'.format(column, id, project, len(ctasks)))
-
-                if column not in projects[project]['columns']:
-                    projects[project]['columns'][column] = ctasks
-                else:
-                    projects[project]['columns'][column] += util.dedupe_list_of_dicts(ctasks)
-
-                if column not in total['columns']:
-                    total['columns'][column] = ctasks
-                else:
-                    total['columns'][column] += util.dedupe_list_of_dicts(ctasks)
-
-        if 'anti' in beinfo:
-            if 'total' not in total['anti']:
-                total['anti']['total'] = 0
-            if 'patterns' not in total['anti']:
-                total['anti']['patterns'] = {}
-            for project, pinfo in projects.items():
-                for anti, antidetails in beinfo['anti'].items():
-                    if antidetails['name'] not in total['anti']['patterns']:
-                        total['anti']['patterns'][antidetails['name']] = []
-
-                    anti_result = getattr(wobj, antidetails['method'])(antidetails, pinfo)
-                    if anti_result:
-                        logging.info("{} anti found count {}".format(project, len(anti_result)))
-                        total['anti']['patterns'][antidetails['name']] += anti_result
-                        total['anti']['patterns'][antidetails['name']] = util.dedupe_list_of_dicts(total['anti']['patterns'][antidetails['name']])
-
-            # Create total out of deduped list counts
-            for pattern, matches in total['anti']['patterns'].items():
-                total['anti']['total'] += len(matches)
-
-        bes[be]['projects'] = projects
-        # Users
-        report_users = cfg['users']['map']
-        users = {}
-
-        if 'count' not in total['users']:
-            total['users']['group']['count'] = len(report_users)
-
-        for u, be_matches in report_users.items():
-            users[u] = {}
-            users[u]['details'] = wobj.get_member_info(u, be_matches[be])
-
-        logging.debug('{} member details'.format(be))
-
-        for u, uinfo in users.items():
-
-            for sa, sa_info in cfg['users']['attributes']['show'].items():
-                sa_backend = sa_info['backend']
-                sa_key = sa_info['key']
-                if be == sa_backend:
-                    uinfo[sa_key] = uinfo['details'][sa]
-
-            if u not in total['users']['individual']:
-                total['users']['individual'][u] = {}
-
-            if 'stats' not in users[u]:
-                users[u]['stats'] = {}
-
-            assigned = wobj.user_assigned(uinfo['details'])
-            if 'assigned' not in users[u]:
-                users[u]['stats']['assigned'] = assigned
-
-            total['users']['group']['assigned'] += util.dedupe_list_of_dicts(assigned)
+    with metrics.stage('tables'):
+        summary_tables(total, bes, cfg)
 
-            if 'stats' not in total['users']['individual'][u]:
-                total['users']['individual'][u]['stats'] = {}
-
-            if 'assigned' not in total['users']['individual'][u]['stats']:
-                total['users']['individual'][u]['stats']['assigned'] = []
-
-            total['users']['individual'][u]['stats']['assigned'] += util.dedupe_list_of_dicts(assigned)
-
-            if 'anti' in cfg['users']:
-
-                if 'antipatterns' not in total['users']['individual'][u]['stats']:
-                    total['users']['individual'][u]['stats']['antipatterns'] = []
-
-                if 'antipatterns' not in total['users']['group']:
-                    total['users']['group']['antipatterns'] = []
-
-                users[u]['antipatterns'] = {}
-                for anti, antidetails in cfg['users']['anti'].items():
-                    anti_result = getattr(wobj, antidetails['method'])(assigned, antidetails, bes[be])
-                    logging.debug("{} {} {}".format(u, anti, len(anti_result)))
-                    if not anti_result:
-                        continue
-
-                    if antidetails['name'] not in users[u]['antipatterns']:
-                        users[u]['antipatterns'][antidetails['name']] = {}
-                    users[u]['antipatterns'][antidetails['name']]['all'] = anti_result
-                    total['users']['individual'][u]['stats']['antipatterns'] += anti_result
-                    total['users']['group']['antipatterns'] += anti_result
-                    logging.info('{} {} assigned {} {} {}'.format(u, be, len(assigned), antidetails['name'], len(anti_result)))
-
-                    users[u]['antipatterns'][antidetails['name']]['shown'] = []
-                    m_shown = users[u]['antipatterns'][antidetails['name']]['all'][:antidetails['show']]
-                    for task in m_shown:
-                        users[u]['antipatterns'][antidetails['name']]['shown'].append(wobj.generate_task_link(task))
-
-            time.sleep(beinfo.get('query_delay', .5))
+    meta['runtime'] = int(time.time() - meta['starttime'])
+    meta['name'] = getname()
+    if cfg.get('metrics', {}).get('footer'):
+        meta['metrics'] = metrics.snapshot()
+
+    with metrics.stage('render'):
+        model = view.build(meta, bes, cfg, total)
+
+        # Pieces go out as they are rendered and the whole report is
+        # only held in memory when it is mailed or asked for.
+        outs = []
+        if echo:
+            outs.append(sys.stdout)
+        if path:
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            outs.append(open(tmp, 'w'))
+        kept = [] if send or keep else None
+        for chunk in view.render(cfg, model, now=int(time.time())):
+            for out in outs:
+                out.write(chunk)
+            if kept is not None:
+                kept.append(chunk)
+        if echo:
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+        if path:
+            outs[-1].close()
+            os.replace(tmp, path)
+        output = ''.join(kept) if kept is not None else None
+
+    if send:
+        now = datetime.datetime.now()
+        subject = "{} {}".format(cfg['job'], now.strftime('%Y-%m-%d'))
+        logging.info("{} sending email '{}'".format(meta['name'], subject))
+        with metrics.stage('send'):
+            util.send_email(
+                cfg['email']['from'],
+                cfg['email']['to'],
+                subject,
+                output,
+                cfg['email']['server']
+            )
+
+    export_metrics(cfg, meta)
+    return output
+
+
+def load_jobs(options, strict=False):
+    """ load every job of a batch file or the one of -c and -j
+    :param options: optparse options
+    :param strict: bool as for load_job
+    :return: list of full configs
+    """
+    if not options.batch:
+        return [load_job(options.config, options.job, options, strict)]
+    with open(options.batch, 'r') as ymlfile:
+        entries = yaml.load(ymlfile, Loader=YAML_LOADER)
+    return [load_job(e.get('config', 'config.yml'), e.get('job', ''), options, strict) for e in entries]
+
+
+def shared_report(cfg, wobjs, **kwargs):
+    """ build a report from backend objects made by shared_backends
+    :param kwargs: as for run_report
+    :return: as for run_report
+    """
+    logging.info('Reporting job {}'.format(cfg['job']))
+    return run_report(cfg, lambda be: wobjs[backend_key(be, cfg['backends'][be])], **kwargs)
+
+
+def output_path(options, cfg):
+    """ where -o asks for a job's report to be written
+    :param options: optparse options
+    :param cfg: dict of full config
+    :return: str or None
+    """
+    return options.output.format(job=cfg['job']) if options.output else None
+
+
+def run_batch(options):
+    """ build every report of a batch file from data fetched once
+    :param options: optparse options
+    """
+    jobs = load_jobs(options)
+    wobjs = shared_backends(jobs)
+    for cfg in jobs:
+        shared_report(cfg, wobjs, echo=options.echo, send=options.send, path=output_path(options, cfg))
+
+
+class Daemon:
+    """keep backends and fetched tasks in memory between reports
+
+    Tasks are fetched again on the refresh schedule while reports are
+    rendered and sent from memory on their own schedules.  The latest
+    report of every job and the run measurements are served over http.
+    """
+    def __init__(self, options):
+        """
+        :param options: optparse options naming the config or batch file
+        """
+        self.options = options
+        self.jobs = load_jobs(options)
+        self.wobjs = {}
+        self.reports = {}
+        self.lock = threading.Lock()
+        self.settings = self.jobs[0].get('daemon', {})
+
+    def refresh(self):
+        """ fetch everything the jobs need again and rebuild their reports
+        Configs are read again so edits to projects and users apply
+        from the next refresh, which costs nothing while unchanged.
+        Configs that fail to read leave the previous ones in use.
+        """
+        metrics.reset()
+        try:
+            self.jobs = load_jobs(self.options, strict=True)
+        except Exception as e:
+            # a half finished edit must not take the daemon down
+            logging.error('Keeping the previous configs as reading them failed: {}'.format(e))
+        self.wobjs = shared_backends(self.jobs, self.wobjs)
+        for cfg in self.jobs:
+            self.render(cfg['job'])
+
+    def render(self, job, send=False):
+        """ rebuild a job's report from memory
+        :param job: str of job name
+        :param send: bool to email it as well
+        """
+        cfg = next((c for c in self.jobs if c['job'] == job), None)
+        if cfg is None:
+            logging.warning('Job {} is no longer configured'.format(job))
+            return
+        output = shared_report(cfg, self.wobjs, send=send, keep=True)
+        with self.lock:
+            self.reports[cfg['job']] = {'time': int(time.time()), 'html': output}
+
+    def page(self, path):
+        """ answer a request for the endpoint
+        :param path: str of request path
+        :return: tuple of (status, content type, body str)
+        """
+        with self.lock:
+            reports = dict(self.reports)
+        if path == '/':
+            links = ''.join(
+                '<li><a href="/report/{0}">{0}</a> {1}</li>'.format(
+                    html.escape(job),
+                    datetime.datetime.fromtimestamp(r['time']).isoformat())
+                for job, r in sorted(reports.items())
+            )
+            return 200, 'text/html', '<ul>{}</ul>'.format(links)
+        if path.startswith('/report/') and urllib.parse.unquote(path[8:]) in reports:
+            return 200, 'text/html', reports[urllib.parse.unquote(path[8:])]['html']
+        if path == '/stats.json':
+            return 200, 'application/json', json.dumps(metrics.snapshot(), indent=2, sort_keys=True)
+        if path == '/metrics':
+            return 200, 'text/plain; version=0.0.4', metrics.prometheus(self.jobs[0]['job'])
+        return 404, 'text/plain', 'not found\n'
+
+    def serve(self, listen):
+        """ answer http requests on a background thread
+        :param listen: str of host:port
+        :return: http.server.ThreadingHTTPServer
+        """
+        daemon = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, ctype, body = daemon.page(self.path.split('?')[0])
+                body = body.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', '{}; charset=utf-8'.format(ctype))
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+        host, port = listen.rsplit(':', 1)
+        server = http.server.ThreadingHTTPServer((host, int(port)), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info('Serving reports on http://{}/'.format(listen))
+        return server
+
+    def run(self):
+        """ fetch, then follow the schedules until interrupted """
+        self.refresh()
+        scheduler = schedule.Scheduler()
+        scheduler.add('refresh', self.settings.get('refresh', '*/30 * * * *'), self.refresh)
+        for cfg in self.jobs:
+            settings = cfg.get('daemon', {})
+            job = cfg['job']
+            if settings.get('render'):
+                scheduler.add('render {}'.format(job), settings['render'], lambda job=job: self.render(job))
+            if settings.get('send'):
+                scheduler.add('send {}'.format(job), settings['send'], lambda job=job: self.render(job, send=True))
+
+        server = self.serve(self.settings.get('listen', '127.0.0.1:8730'))
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            logging.info('Stopping')
+        finally:
+            server.shutdown()
 
-        bes[be]['users'] = users
 
-    total['projects']['history']['summary_table'] = format.tasks_summary_table(total['summary_header'], total['projects']['history'])
+def main():
 
-    env = Environment(
-        loader=FileSystemLoader(cfg['templates']))
+    parser = optparse.OptionParser()
+    parser.add_option('-c', '--config', default='config.yml', dest="config", type="str")
+    parser.add_option('-j', '--job', default='', dest="job", type="str")
+    parser.add_option('-p', action='store_true', default=False, dest='echo')
+    parser.add_option('-s', action='store_true', default=False, dest='send')
+    parser.add_option('-v', action='store_true', default=False, dest='verbose')
+    parser.add_option('-o', '--output', default='', dest='output', type='str',
+                      help='write the report to this file, {job} is replaced by the job name')
+    parser.add_option('--batch', default='', dest='batch', type='str',
+                      help='yaml list of config and job pairs reported from one shared fetch')
+    parser.add_option('--daemon', action='store_true', default=False, dest='daemon',
+                      help='keep running, refreshing and reporting on the daemon schedules')
+    parser.add_option('--profile', default='', dest='profile', type='str',
+                      help='write cpu profiles and memory of each stage to this directory')
+    parser.add_option('--profile-allocations', action='store_true', default=False, dest='profile_allocations',
+                      help='with --profile also write the allocation sites the run grew by, slow on big boards')
+    parser.add_option('--record', default='', dest='record', type='str',
+                      help='save every backend api request and response to this directory')
+    parser.add_option('--replay', default='', dest='replay', type='str',
+                      help='answer backend api requests from a --record directory')
+    parser.add_option('--refresh-directory', action='store_true', default=False, dest='refresh_directory',
+                      help='drop stored users, projects and workspaces before running')
 
-    template = env.get_template('body.html')
+    options, remainder = parser.parse_args()
 
-    meta['runtime'] = int(time.time() - meta['starttime'])
-    meta['name'] = getname()
+    logging.basicConfig(
+        level=logging.DEBUG if options.verbose else logging.INFO,
+        format="%(asctime)s:%(levelname)s:%(message)s"
+    )
+    logging.debug(options)
 
-    data = [meta, bes, cfg, total]
-    template.globals['now'] = int(time.time())
-    output = template.render(data=data)
+    profiler = profiling.enable(options.profile, options.profile_allocations) if options.profile else None
 
-    if options.echo:
-        print(output)
+    if options.daemon:
+        Daemon(options).run()
+    elif options.batch:
+        run_batch(options)
+    else:
+        cfg = load_job(options.config, options.job, options)
+        run_report(cfg, echo=options.echo, send=options.send, path=output_path(options, cfg))
+    tape.close()
 
-    if options.send:
-        now = datetime.datetime.now()
-        subject = "{} {}".format(cfg['job'], now.strftime('%Y-%m-%d'))
-        logging.info("{} sending email '{}'".format(meta['name'], subject))
-        util.send_email(
-            cfg['email']['from'],
-            cfg['email']['to'],
-            subject,
-            output,
-            cfg['email']['server']
-        )
+    if profiler:
+        profiler.close()
+        logging.info('profiles written to {}'.format(options.profile))
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,17 @@
 import asana
+import functools
+import re
+import threading
 import time
 import datetime as dt
+from plib import cache
+from plib import directory
+from plib import metrics
+from plib import ratelimit
+from plib import summary
+from plib import tape
+from plib import timeindex
+from plib.task import Task
 
 
 class Status:
@@ -29,16 +40,51 @@ class Status:
         self.logger = None
         self.space = None
         self.projects = []
+        # every project of the workspace, for antipattern rules naming one
+        self.workspace_projects = []
         self.space_users = []
+        # user details by gid kept for every report sharing this object
+        self.user_details = {}
+        # optional on disk copy of project tasks so runs only sync what changed
+        self.cache = cache.TaskCache(kwargs['cache']) if kwargs.get('cache') else None
+        # optional on disk store of workspaces, projects and users, see lookup
+        self.directory = directory.get(kwargs['directory']) if kwargs.get('directory') else None
+        self.directory_ttl = kwargs.get('directory_ttl', 86400)
+        if self.directory and kwargs.get('directory_refresh'):
+            self.directory.invalidate('asana/')
+        # optional capture or playback of every api request
+        self.tape = tape.get('asana', kwargs.get('record'), kwargs.get('replay'))
+        # guards lazily loaded workspace, project and user details
+        # as callers may share this object across worker threads
+        self.lock = threading.RLock()
         # project gid/task gid
         self.task_fmt = 'https://app.asana.com/0/{}/{}'
         self.project_fmt = 'https://app.asana.com/0/{}/'
 
         if kwargs['token']:
+            # Rate limits and server errors are retried by the shared
+            # limiter rather than the client's own fixed retry sleeps
             self.con = asana.Client.access_token(kwargs['token'])
+            self.con.options['max_retries'] = 0
+            if kwargs.get('base_url'):
+                self.con.options['base_url'] = kwargs['base_url']
+            # Collections page lazily so throttle each request
+            # rather than each resource call
+            self.request = self.con.request
+            self.con.request = self.call
+            self.con.session.hooks['response'].append(
+                lambda response, *args, **kwargs: metrics.receive(len(response.content))
+            )
         else:
             self.con = None
 
+        query_delay = kwargs.get('query_delay', .5)
+        self.limiter = ratelimit.get(
+            self.con.options['base_url'] if self.con else None,
+            kwargs.get('rate', 1 / query_delay if query_delay else 0),
+            kwargs.get('burst', 5)
+        )
+
         # To get content add: "this.notes"
         self.task_fields = [
             "this.name",
@@ -52,10 +98,58 @@ class Status:
             "this.name",
         ]
 
+    def call(self, method, path, **options):
+        """ make a rate limited asana http request
+        :param method: str of http method
+        :param path: str of api path
+        :return: response data
+        """
+        endpoint = '{} {}'.format(method.upper(), re.sub(r'/\d+', '/:gid', path))
+        request = self.request
+        if self.tape:
+            # the query names a request, client options such as base_url do not
+            named = dict((k, options.get(k)) for k in ('params', 'data'))
+            request = functools.partial(self.tape.call, '{} {}'.format(method.upper(), path), named, request)
+        if self.tape and self.tape.mode == 'replay':
+            # answered from disk so there is nothing to throttle
+            result = metrics.call('asana', endpoint, request, method, path, **options)
+        else:
+            result = self.limiter.call(metrics.call, 'asana', endpoint, request, method, path, **options)
+        # collections are asked for a page at a time with a limit
+        if 'limit' in options.get('params', {}):
+            metrics.page('asana', endpoint)
+        return result
+
+    def lookup(self, kind, key, fetch, found=None):
+        """ fetch through the directory when one is configured
+        :param kind: str of what is looked up e.g. 'users'
+        :param key: str naming the lookup
+        :param fetch: callable making the api calls
+        :param found: callable that is False when a stored value lacks
+                      what the caller needs, which is then fetched again
+        :return: value
+        """
+        if not self.directory:
+            return fetch()
+        namespace = 'asana/' + kind
+        value = self.directory.get(namespace, key, self.directory_ttl)
+        if value is None or (found and not found(value)):
+            value = fetch()
+            self.directory.put(namespace, key, value)
+        return value
+
+    def refresh(self):
+        """ forget fetched tasks so the next report asks again
+        The workspace, projects and users are kept, so with a cache
+        only tasks modified since are fetched.
+        """
+        with self.lock:
+            self.task_history = {}
+
     def progress_column(self, project, tasks):
         progress = []
         for task in tasks:
-            if task['assignee'] and not task['completed']:
+            if task.owner and not task.completed:
                 self.logging('marked as progress: {}\n'.format(task))
                 progress.append(task)
         return progress
@@ -63,7 +157,7 @@ class Status:
     def backlog_column(self, project, tasks):
         backlog = []
         for task in tasks:
-            if not task['assignee'] and not task['completed']:
+            if not task.owner and not task.completed:
                 self.logging('marked as backlog: {}\n'.format(task))
                 backlog.append(task)
         return backlog
@@ -80,7 +174,7 @@ class Status:
 
     def generate_task_link(self, task):
         try:
-            return self.task_fmt.format(task['projects'][0]['gid'], task['gid']), task['name']
+            return self.task_fmt.format(task.projects[0], task.key), task.name
         except Exception:
             self.logging('failed to generate link for {}'.format(task))
             raise
@@ -92,23 +186,34 @@ class Status:
         the name validate.
         :action: sets self.space with dict
         """
-        if self.space:
-            return self.space
-
-        workspaces = self.con.workspaces.find_all()
-
-        self.space = None
-        for i, val in enumerate(workspaces):
-            if val['name'] == self.args['workspace']:
-                self.space = val
+        with self.lock:
+            if self.space:
                 return self.space
-        else:
-            raise Exception('Not a valid Asana Workspace')
+
+            workspaces = self.lookup(
+                'workspaces',
+                '',
+                lambda: list(self.con.workspaces.find_all()),
+                lambda spaces: any(s['name'] == self.args['workspace'] for s in spaces)
+            )
+
+            self.space = None
+            for i, val in enumerate(workspaces):
+                if val['name'] == self.args['workspace']:
+                    self.space = val
+                    return self.space
+            else:
+                raise Exception('Not a valid Asana Workspace')
 
     def get_project_info(self):
         # TODO: integrate this with a parent class stub for phab
         workspace = self.get_workspace()
-        projects = self.con.projects.find_all({'workspace': workspace['gid']})
+        projects = self.lookup(
+            'projects',
+            workspace['gid'],
+            lambda: list(self.con.projects.find_all({'workspace': workspace['gid']})),
+            lambda found: set(self.args['projects']) <= set(p['name'] for p in found)
+        )
 
         proj_info = {}
         for i, val in enumerate(projects):
@@ -122,16 +227,48 @@ class Status:
 
         self.logging('Setting project_info: {}'.format(proj_info))
         self.projects = proj_info
+        self.workspace_projects = projects
 
     def date_to_epoch(self, date_str):
         # 2020-04-01T21:23:54.346Z
         mdate = dt.datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%S.%fZ')
         return mdate.timestamp()
 
+    def to_task(self, task):
+        """ convert an asana task into a compact record
+        :param task: asana task dict with self.task_fields
+        :return: Task
+        """
+        return Task(
+            backend='asana',
+            key=task['gid'],
+            id=task['gid'],
+            name=task['name'],
+            created=self.date_to_epoch(task['created_at']),
+            modified=self.date_to_epoch(task['modified_at']),
+            owner=task['assignee']['gid'] if task['assignee'] else None,
+            completed=task['completed'],
+            projects=tuple(p['gid'] for p in task['projects']),
+        )
+
+    def epoch_to_date(self, epoch):
+        """ inverse of date_to_epoch """
+        return dt.datetime.fromtimestamp(epoch).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
     def get_member_info(self, realname, username, agents=False):
-        if not self.space_users:
-            space_users = self.con.users.get_users_for_workspace(self.space['gid'])
-            self.space_users = list(space_users)
+        def named(users):
+            return any(u['name'] == username for u in users)
+
+        with self.lock:
+            # a stored listing may predate someone joining
+            if not named(self.space_users):
+                gid = self.get_workspace()['gid']
+                self.space_users = self.lookup(
+                    'users',
+                    gid,
+                    lambda: list(self.con.users.get_users_for_workspace(gid)),
+                    named
+                )
 
         gid = [u['gid'] for u in self.space_users if u['name'] == username]
         if len(gid):
@@ -146,56 +283,99 @@ class Status:
                             realname,
                             ')"']))
 
-    def get_user_info(self, id):
-        return self.con.users.find_by_id(id)
-
-    def get_user_assigned_tasks(self, gid):
-
-        # TODO: gotta be a saner way to query for open and assigned
-        # assigned_generator = self.con.tasks.find_all({'assignee': gid,
-        #                                                'workspace': self.space['gid'],
-        #                                                "opt_fields":self.task_fields})
-        # return [t for t in list(assigned_generator) if not t['completed']]
+    def get_members_info(self, usernames, agents=False):
+        """ resolve many users, workspace users are only listed once
+        :param usernames: dict of report name to asana user name
+        :return: dict of report name to user details
+        """
+        return dict((r, self.get_member_info(r, u, agents)) for r, u in usernames.items())
 
+    def get_user_info(self, id):
+        if id not in self.user_details:
+            self.user_details[id] = self.lookup('user', id, lambda: self.con.users.find_by_id(id))
+        return self.user_details[id]
+
+    def get_user_assigned_tasks(self, gid, projects=None):
+        """ open tasks assigned to a user in the loaded projects
+        Read from each project's assignee index so the cost follows
+        the user's own tasks rather than every task of every project.
+        :param gid: str of asana user gid
+        :param projects: names of the projects a report covers, as one
+                         object may have loaded those of other reports,
+                         by default every loaded project
+        :return: list of Task
+        """
         assigned = []
         for project, details in self.task_history.items():
-            for task in details['tasks_dedup']:
-                if task['assignee'] and task['assignee']['gid'] == gid:
-                    if not task['completed']:
-                        assigned.append(task)
+            if projects is None or project in projects:
+                assigned += details['assigned'].get(gid, ())
         return assigned
 
-    def user_assigned(self, user_details):
-        return self.get_user_assigned_tasks(user_details['gid'])
-
-    def task_mod_before_date(self, tasks, mtime):
-        modded = []
-        for task in tasks:
-            if self.date_to_epoch(task['modified_at']) < mtime:
-                modded.append(task)
-
-        return sorted(modded, key=lambda i: i['modified_at'])
-
-    def task_mod_after_date(self, tasks, mtime):
-        modded = []
-        for task in tasks:
-            if self.date_to_epoch(task['modified_at']) > mtime:
-                modded.append(task)
+    def user_key(self, user_details):
+        """ what a task's owner is set to for a user
+        :param user_details: dict as returned by get_member_info
+        :return: str of gid
+        """
+        return user_details['gid']
 
-        return sorted(modded, key=lambda i: i['modified_at'])
+    def project_keys(self, names):
+        """ gids of workspace projects by name for antipattern rules
+        Read from the project listing already loaded for the report.
+        :param names: list of project names
+        :return: dict of lower cased name to gid
+        """
+        with self.lock:
+            if not self.projects:
+                self.get_project_info()
+        wanted = set(n.lower() for n in names)
+        return dict((p['name'].lower(), p['gid']) for p in self.workspace_projects if p['name'].lower() in wanted)
+
+    def user_assigned(self, user_details, projects=None):
+        return self.get_user_assigned_tasks(user_details['gid'], projects)
+
+    def users_assigned(self, users_details, projects=None):
+        """ assigned tasks for many users from the already loaded projects
+        :param users_details: list of user details dicts
+        :param projects: names of the projects a report covers
+        :return: list of task lists in the order of users_details
+        """
+        return [self.user_assigned(u, projects) for u in users_details]
 
     def task_created_after_date(self, tasks, ctime):
-        created_after = []
-        for task in tasks:
-            if self.date_to_epoch(task['created_at']) > ctime:
-                created_after.append(task)
+        return timeindex.index(tasks).created_after(ctime)
+
+    def get_project_tasks(self, gid, modified_since=None):
+        params = {'project': gid, 'opt_fields': self.task_fields}
+        if modified_since:
+            params['modified_since'] = modified_since
+        return self.con.tasks.find_all(params)
+
+    def sync_project_tasks(self, gid):
+        """ bring the local copy of a project's tasks up to date
+        Only tasks modified since the stored watermark are requested.
+        Tasks deleted or moved out of the project are not reported by
+        modified_since and linger until the store is removed.
+        :param gid: str of project gid
+        :return: list of every task known for the project
+        """
+        state = self.cache.sync_state(gid)
+        if state:
+            watermark = state[1]
+            self.logging('{}: syncing tasks modified since {}'.format(gid, watermark))
+            tasks_raw = self.get_project_tasks(gid, self.epoch_to_date(watermark))
+        else:
+            watermark = 0
+            tasks_raw = self.get_project_tasks(gid)
 
-        return sorted(created_after, key=lambda i: i['created_at'])
+        changed = []
+        for t in tasks_raw:
+            modified = self.date_to_epoch(t['modified_at'])
+            watermark = max(watermark, modified)
+            changed.append((t['gid'], self.date_to_epoch(t['created_at']), modified, t))
 
-    def get_project_tasks(self, gid):
-        return self.con.tasks.find_all(
-            {'project': gid, 'opt_fields': self.task_fields}
-        )
+        self.logging('{}: synced {} changed tasks'.format(gid, len(changed)))
+        self.cache.update(gid, changed, 0, watermark)
+        return self.cache.tasks(gid)
 
     def get_tasks_created_since(self, project, days):
         """ get tasks from last n days with summary stats
@@ -206,11 +386,12 @@ class Status:
         start_time = int(time.time()) - (days * 86400)
         self.logging('"{}": days {} start time {}'.format(project, days, start_time))
 
-        if not self.projects:
-            self.get_project_info()
+        with self.lock:
+            if not self.projects:
+                self.get_project_info()
 
-        if project in self.task_history and start_time > self.task_history[project]['start_time']:
-            cached_tasks = self.task_history[project]['tasks']
+        if project in self.task_history and start_time >= self.task_history[project]['start_time']:
+            cached_tasks = self.task_history[project]['tasks_dedup']
             self.logging('{} cached for {} days ({})'.format(project, days, len(cached_tasks)))
             created_after = self.task_created_after_date(cached_tasks, start_time)
             self.logging('{} cached for {} days ({})'.format(project, days, len(created_after)))
@@ -218,60 +399,78 @@ class Status:
 
         pgid = self.projects[project]['gid']
         self.logging('{}: querying API for tasks'.format(self.projects[project]['name']))
-        tasks_raw = self.get_project_tasks(pgid)
+        if self.cache:
+            tasks_raw = self.sync_project_tasks(pgid)
+        else:
+            tasks_raw = self.get_project_tasks(pgid)
 
         task_dedup = []
-        for t in tasks_raw:
-            if any([*map(lambda i: i in t['name'], self.args['ignore'])]):
-                self.logging('Ingnoring as dupe: {}'.format(t['name']))
+        for t in map(self.to_task, tasks_raw):
+            if any([*map(lambda i: i in t.name, self.args['ignore'])]):
+                self.logging('Ingnoring as dupe: {}'.format(t.name))
             else:
                 task_dedup.append(t)
 
         self.logging('Dedupe task count from "{}": {}'.format(project, len(task_dedup)))
 
+        # later durations and columns read the project from its index
+        task_dedup = timeindex.TimeIndex(task_dedup)
         tasks_from_date = self.task_created_after_date(task_dedup, start_time)
 
-        self.task_history[project] = {}
-        self.task_history[project]['start_time'] = start_time
-        self.task_history[project]['tasks'] = tasks_from_date
-        self.task_history[project]['tasks_dedup'] = task_dedup
+        self.set_history(project, start_time, task_dedup)
         return tasks_from_date
 
+    def set_history(self, project, start_time, tasks):
+        """ keep a project's loaded tasks and index them by assignee
+        :param project: str
+        :param start_time: epoch the tasks were loaded from
+        :param tasks: TimeIndex of deduplicated project tasks
+        """
+        assigned = {}
+        for task in tasks:
+            if task.owner and not task.completed:
+                assigned.setdefault(task.owner, []).append(task)
+
+        self.task_history[project] = {
+            'start_time': start_time,
+            'tasks_dedup': tasks,
+            'assigned': assigned,
+        }
+
     def tasks_summary(self, tasks, enabled_fields):
         """ returns a dict of summary info about a list of tasks
         :param tasks: list
         :return: list of summary dicts by summary_field
         """
-        summary = {}
-        summary_fields = {'status': 'completed'}
-
-        # return count(s) of unique summary_field items for all tasks
-        for field, key in summary_fields.items():
-            if field not in enabled_fields:
-                continue
-
-            summary[field] = {}
-            for task in tasks:
-                extracted = task.get(key, None)
-                if extracted is not None:
-                    if extracted not in summary[field]:
-                        summary[field][extracted] = 0
-                    summary[field][extracted] += 1
-
-        # As status is a bool set to human readable
-        # If more fields need this treatment down the road
-        # rethink the definition datastructure to include this logic
-        status = {}
-        status_bool = summary['status']
-        for k, v in status_bool.items():
-            if k:
-                status['resolved'] = v
+        return self.tasks_summaries(tasks, {None: len(tasks)}, enabled_fields)[None]
 
-            else:
-                status['open'] = v
-
-        summary['status'] = status
-        return summary
+    def tasks_summaries(self, tasks, windows, enabled_fields):
+        """ summary info for nested windows of a task list in one pass
+        :param tasks: list covering the widest window
+        :param windows: dict of window to the number of newest tasks it covers
+        :return: dict of window to summary dicts by summary_field
+        """
+        summary_fields = {'status': 'completed'}
+        fields = dict((f, k) for f, k in summary_fields.items() if f in enabled_fields)
+
+        summaries = summary.summarize(tasks, windows, fields)
+        for counts in summaries.values():
+            for field, values in counts.items():
+                counts[field] = dict((k, v) for k, v in values.items() if k is not None)
+
+            # As status is a bool set to human readable
+            # If more fields need this treatment down the road
+            # rethink the definition datastructure to include this logic
+            if 'status' in counts:
+                status = {}
+                for k, v in counts['status'].items():
+                    if k:
+                        status['resolved'] = v
+
+                    else:
+                        status['open'] = v
+                counts['status'] = status
+        return summaries
 
     def column_tasks(self, column, project):
         """ Get tasks by workboard column
@@ -293,12 +492,3 @@ class Status:
 
         function = columns[column]
         return function(project, self.task_history[project]['tasks_dedup'])
-
-    def anti_moldy(self, assigned, antinfo, beinfo):
-        best_by_date = antinfo['age']
-        moldy_threshold = int(time.time()) - best_by_date
-        return self.task_mod_before_date(assigned, moldy_threshold)
-
-    def anti_assigned_wo_reporting_project(self, tasks, antinfo, beinfo):
-        """put in superclass"""
-        return []
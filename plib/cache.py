@@ -0,0 +1,83 @@
+import json
+import sqlite3
+import threading
+
+
+class TaskCache:
+    """on disk task store keyed by backend task id
+
+    Tasks are stored once and linked to every project they were
+    synced for.  Each project keeps the earliest creation time it
+    covers and a watermark of the newest modification seen so a
+    later run only needs to ask for what changed since.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id TEXT PRIMARY KEY,
+                    created REAL NOT NULL,
+                    modified REAL NOT NULL,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS project_tasks (
+                    project TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    PRIMARY KEY (project, id)
+                );
+                CREATE TABLE IF NOT EXISTS sync (
+                    project TEXT PRIMARY KEY,
+                    start REAL NOT NULL,
+                    watermark REAL NOT NULL
+                );
+            """)
+
+    def sync_state(self, project):
+        """ get what is stored for a project
+        :param project: str
+        :return: tuple of (start, watermark) or None if never synced
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT start, watermark FROM sync WHERE project = ?',
+                (project,)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def update(self, project, tasks, start, watermark):
+        """ store tasks for a project and move its watermark
+        :param project: str
+        :param tasks: list of (id, created, modified, task dict) tuples
+        :param start: epoch of the earliest creation time covered
+        :param watermark: epoch of the newest modification synced
+        """
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO tasks (id, created, modified, data) VALUES (?, ?, ?, ?)',
+                [(str(i), c, m, json.dumps(t)) for i, c, m, t in tasks]
+            )
+            self.db.executemany(
+                'INSERT OR IGNORE INTO project_tasks (project, id) VALUES (?, ?)',
+                [(project, str(t[0])) for t in tasks]
+            )
+            self.db.execute(
+                'INSERT OR REPLACE INTO sync (project, start, watermark) VALUES (?, ?, ?)',
+                (project, start, watermark)
+            )
+
+    def tasks(self, project, created_start=0):
+        """ get stored tasks for a project
+        :param project: str
+        :param created_start: epoch tasks must be created at or after
+        :return: list of task dicts ordered by creation time
+        """
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT t.data FROM tasks t JOIN project_tasks p ON p.id = t.id '
+                'WHERE p.project = ? AND t.created >= ? ORDER BY t.created',
+                (project, created_start)
+            ).fetchall()
+        return [json.loads(r[0]) for r in rows]
@@ -0,0 +1,101 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+# one directory per file shared by every backend in the process
+directories = {}
+directories_lock = threading.Lock()
+
+
+def get(path):
+    """ get the shared directory stored at a path
+    :param path: str of sqlite file
+    :return: Directory
+    """
+    with directories_lock:
+        if path not in directories:
+            directories[path] = Directory(path)
+        return directories[path]
+
+
+class Directory:
+    """on disk store of identity and project metadata
+
+    Users, projects and workspaces barely change between runs so
+    each lookup is kept for a time to live rather than asked for
+    again.  Entries are grouped by a namespace such as 'phab/user'
+    so a backend can drop its own without touching the others.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    stored REAL NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+            """)
+
+    def get(self, namespace, key, ttl):
+        """ get a stored value that is still fresh
+        :param namespace: str
+        :param key: str
+        :param ttl: seconds an entry stays fresh
+        :return: stored value or None
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT data FROM entries WHERE namespace = ? AND key = ? AND stored >= ?',
+                (namespace, key, time.time() - ttl)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, namespace, key, value):
+        """ store a value
+        :param namespace: str
+        :param key: str
+        :param value: json serializable value
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO entries (namespace, key, stored, data) VALUES (?, ?, ?, ?)',
+                (namespace, key, time.time(), json.dumps(value))
+            )
+
+    def lookup(self, namespace, key, ttl, fetch):
+        """ get a fresh stored value or fetch and store it
+        :param namespace: str
+        :param key: str
+        :param ttl: seconds an entry stays fresh
+        :param fetch: callable returning the value when not stored
+        :return: value
+        """
+        value = self.get(namespace, key, ttl)
+        if value is None:
+            value = fetch()
+            self.put(namespace, key, value)
+        return value
+
+    def invalidate(self, prefix, key=None):
+        """ drop stored entries
+        :param prefix: str namespace or the start of one e.g. 'asana/'
+        :param key: str to drop a single entry of the namespace
+        """
+        with self.lock, self.db:
+            if key is None:
+                self.db.execute(
+                    'DELETE FROM entries WHERE substr(namespace, 1, ?) = ?',
+                    (len(prefix), prefix)
+                )
+            else:
+                self.db.execute(
+                    'DELETE FROM entries WHERE namespace = ? AND key = ?',
+                    (prefix, key)
+                )
@@ -1,55 +1,36 @@
-import copy
-
-
-def tasks_summary_header(tasks_summary, duration_header='days'):
+def tasks_summary_header(matrix, projects=None):
     """create dicts for sane table building in html
 
-    TODO: This is cleaner in the presentation layer,
-    however my masochism for jinja2 templates
-    has now exceeded my pragmatism quotient.
+    The same metric may have different columns in different
+    durations and projects.  Make sure this is inclusive of all
+    in order for the tables to be readable and consistent.
+    :param matrix: SummaryMatrix
+    :param projects: list of project keys, all when None
+    :return: dict of summary field to sorted list of values
     """
+    return dict((f, sorted(v)) for f, v in matrix.reduce(projects).items())
 
-    headers = {}
-    # The same metric may have different columns in different
-    # durations.  Make sure this is inclusive of all in order
-    # for the table to be readable and consistent.  Durations
-    # without a specific column value will be assigned a default
-    # value later on.
-    for metric_set in tasks_summary.values():
-        for title, metric in metric_set['stats'].items():
-            if title not in headers:
-                headers[title] = []
-                headers[title] += sorted(list(metric.keys()))
-            else:
-                headers[title] = sorted(list(set(headers[title])))
-    return headers
 
-
-def tasks_summary_table(headers, tasks_summary):
+def tasks_summary_table(matrix, headers, projects=None):
     """create dicts for sane table building in html
 
-    TODO: This is maybe cleaner in the presentation layer,
-    however my masochism for jinja2 templates
-    has now exceeded my pragmatism quotient.
+    Reflows the stats summary from by duration to by attribute
+    with a column per header and zero where a value was not seen.
+    :param matrix: SummaryMatrix
+    :param headers: dict as returned by tasks_summary_header
+    :param projects: list of project keys summed into the table
+    :return: dict of summary field to table dict
     """
-    # Reflow the stats summary from by duration to by attribute
-    metrics_table = {}
+    totals = matrix.reduce(projects)
 
-    for k, v in headers.items():
-        metrics_table[k] = {}
-        metrics_table[k]['header'] = copy.deepcopy(v)
-        metrics_table[k]['durations'] = {}
-
-    for duration, metrics in tasks_summary.items():
-        for stat_name, values in metrics['stats'].items():
-            for table_name, table_row in metrics_table.items():
-                if duration not in metrics_table[table_name]['durations']:
-                    metrics_table[table_name]['durations'][duration] = []
-                if stat_name == table_name:
-                    for header in table_row['header']:
-                        metrics_table[table_name]['durations'][duration].append(values.get(header) or 0)
-
-    # Insert the header for durations themselves
-    for table in metrics_table:
-        metrics_table[table]['header'].insert(0, 'days')
+    metrics_table = {}
+    for field, header in headers.items():
+        counts = totals.get(field, {})
+        columns = [counts.get(value) or [0] * len(matrix.durations) for value in header]
+
+        metrics_table[field] = {}
+        metrics_table[field]['header'] = ['days'] + header
+        metrics_table[field]['durations'] = {}
+        for i, duration in enumerate(matrix.durations):
+            metrics_table[field]['durations'][duration] = [c[i] for c in columns]
     return metrics_table
@@ -0,0 +1,194 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# upper bounds in seconds of the api latency histogram
+BUCKETS = (.05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+# one set of measurements per process shared by every caller
+stages = {}
+calls = {}
+lock = threading.Lock()
+# bytes read by the api call in flight on this thread
+received = threading.local()
+# objects with start(name) and stop(name) told about every stage
+observers = []
+
+
+def reset():
+    """ forget everything measured so far """
+    with lock:
+        stages.clear()
+        calls.clear()
+
+
+@contextmanager
+def stage(name):
+    """ time a stage of the report
+    Stages run on worker threads may overlap so each keeps the
+    total time spent in it and how many times it ran.
+    :param name: str such as 'phab/columns'
+    """
+    for observer in observers:
+        observer.start(name)
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - start
+        with lock:
+            info = stages.setdefault(name, {'count': 0, 'seconds': 0.0})
+            info['count'] += 1
+            info['seconds'] += elapsed
+        for observer in reversed(observers):
+            observer.stop(name)
+
+
+def receive(size):
+    """ note bytes read for the api call on this thread
+    :param size: int
+    """
+    received.bytes = getattr(received, 'bytes', 0) + size
+
+
+def call(backend, endpoint, function, *args, **kwargs):
+    """ make an api request recording its latency and size
+    :param backend: str of backend name
+    :param endpoint: str of api method or path
+    :param function: callable making one request
+    :return: result of function
+    """
+    received.bytes = 0
+    start = time.monotonic()
+    error = False
+    try:
+        return function(*args, **kwargs)
+    except Exception:
+        error = True
+        raise
+    finally:
+        elapsed = time.monotonic() - start
+        with lock:
+            info = calls.setdefault((backend, endpoint), {
+                'count': 0,
+                'errors': 0,
+                'pages': 0,
+                'bytes': 0,
+                'seconds': 0.0,
+                'buckets': [0] * len(BUCKETS),
+            })
+            info['count'] += 1
+            info['errors'] += error
+            info['bytes'] += received.bytes
+            info['seconds'] += elapsed
+            for i, bound in enumerate(BUCKETS):
+                if elapsed <= bound:
+                    info['buckets'][i] += 1
+
+
+def page(backend, endpoint):
+    """ count a page of paged results
+    :param backend: str of backend name
+    :param endpoint: str of api method or path
+    """
+    with lock:
+        if (backend, endpoint) in calls:
+            calls[(backend, endpoint)]['pages'] += 1
+
+
+def snapshot():
+    """ everything measured so far
+    :return: dict of 'stages' and 'calls' ready for json
+    """
+    with lock:
+        return {
+            'stages': dict((n, dict(i, seconds=round(i['seconds'], 4))) for n, i in sorted(stages.items())),
+            'calls': [
+                dict(info, backend=be, endpoint=ep, seconds=round(info['seconds'], 4), buckets=list(info['buckets']))
+                for (be, ep), info in sorted(calls.items())
+            ],
+            'buckets': list(BUCKETS),
+        }
+
+
+def replace(path, content):
+    """ write a file so readers never see it half written
+    :param path: str
+    :param content: str
+    """
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as out:
+        out.write(content)
+    os.replace(tmp, path)
+
+
+def write_json(path, report, extra=None):
+    """ write measurements as json
+    :param path: str
+    :param report: str of report job name
+    :param extra: dict of more top level values such as runtime
+    """
+    data = snapshot()
+    data['report'] = report
+    data['time'] = int(time.time())
+    data.update(extra or {})
+    replace(path, json.dumps(data, indent=2, sort_keys=True) + '\n')
+
+
+def prometheus(report, extra=None):
+    """ measurements in the prometheus text exposition format
+    :param report: str of report job name
+    :param extra: dict of more gauges by metric name
+    :return: str
+    """
+    def labels(**kwargs):
+        pairs = [('report', report)] + sorted(kwargs.items())
+        return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+    data = snapshot()
+    lines = []
+
+    lines.append('# HELP peek_stage_seconds Seconds spent in each report stage.')
+    lines.append('# TYPE peek_stage_seconds gauge')
+    for name, info in data['stages'].items():
+        lines.append('peek_stage_seconds{{{}}} {}'.format(labels(stage=name), info['seconds']))
+
+    lines.append('# HELP peek_api_request_seconds Backend api request latency.')
+    lines.append('# TYPE peek_api_request_seconds histogram')
+    for info in data['calls']:
+        for bound, count in zip(data['buckets'], info['buckets']):
+            lines.append('peek_api_request_seconds_bucket{{{}}} {}'.format(
+                labels(backend=info['backend'], endpoint=info['endpoint'], le=bound), count))
+        lines.append('peek_api_request_seconds_bucket{{{}}} {}'.format(
+            labels(backend=info['backend'], endpoint=info['endpoint'], le='+Inf'), info['count']))
+        lines.append('peek_api_request_seconds_sum{{{}}} {}'.format(
+            labels(backend=info['backend'], endpoint=info['endpoint']), info['seconds']))
+        lines.append('peek_api_request_seconds_count{{{}}} {}'.format(
+            labels(backend=info['backend'], endpoint=info['endpoint']), info['count']))
+
+    for metric, key, help in [
+        ('peek_api_errors_total', 'errors', 'Backend api requests that failed.'),
+        ('peek_api_pages_total', 'pages', 'Pages of paged results fetched.'),
+        ('peek_api_received_bytes_total', 'bytes', 'Bytes of api responses received.'),
+    ]:
+        lines.append('# HELP {} {}'.format(metric, help))
+        lines.append('# TYPE {} counter'.format(metric))
+        for info in data['calls']:
+            lines.append('{}{{{}}} {}'.format(metric, labels(backend=info['backend'], endpoint=info['endpoint']), info[key]))
+
+    for metric, value in sorted((extra or {}).items()):
+        lines.append('# TYPE {} gauge'.format(metric))
+        lines.append('{}{{{}}} {}'.format(metric, labels(), value))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, report, extra=None):
+    """ write measurements for the node exporter textfile collector
+    :param path: str ending in .prom
+    :param report: str of report job name
+    :param extra: dict of more gauges by metric name
+    """
+    replace(path, prometheus(report, extra))
@@ -1,7 +1,30 @@
+import functools
+import json
+import threading
 import time
-from phabricator import Phabricator
+from concurrent.futures import ThreadPoolExecutor
+import phabricator
+from plib import cache
+from plib import directory
+from plib import metrics
+from plib import ratelimit
+from plib import summary
+from plib import tape
+from plib import timeindex
 from plib import util
-from collections import Counter
+from plib.task import Task
+
+
+# every conduit method called, the client is given only their specs
+# rather than building and copying the whole interface per connection
+METHODS = ('maniphest.search', 'project.query', 'user.query', 'user.whoami')
+
+
+def interface():
+    """ conduit specs of the methods used
+    :return: dict of application to method to spec
+    """
+    return phabricator.parse_interfaces(dict((m, phabricator.INTERFACES[m]) for m in METHODS))
 
 
 class Status:
@@ -10,98 +33,312 @@ class Status:
 
         self.args = kwargs
         self.members = []
+        # project.query results by the reporting projects asked for
         self.project_details = {}
         self.task_history = {}
+        # open tasks per project with their workboard columns
+        self.boards = {}
+        self.board_locks = {}
+        # what was fetched once is kept for every report sharing this object
+        self.columns = {}
+        self.known_users = {}
+        self.assigned = {}
         self.logger = None
+        # conduit resources by method name, see method
+        self.methods = {}
+        self.methods_lock = threading.Lock()
+        # guards lazily loaded project details as callers
+        # may share this object across worker threads
+        self.lock = threading.Lock()
+
+        # optional on disk store so runs only sync what changed
+        self.cache = cache.TaskCache(kwargs['cache']) if kwargs.get('cache') else None
+        # optional on disk store of users and projects, see lookup
+        self.directory = directory.get(kwargs['directory']) if kwargs.get('directory') else None
+        self.directory_ttl = kwargs.get('directory_ttl', 86400)
+        if self.directory and kwargs.get('directory_refresh'):
+            self.directory.invalidate('phab/')
+        # optional capture or playback of every conduit call
+        self.tape = tape.get('phab', kwargs.get('record'), kwargs.get('replay'))
 
         self.task_fmt = "https://phabricator.wikimedia.org/T{}"
         self.project_fmt = "https://phabricator.wikimedia.org/tag/{}"
 
         if kwargs['host']:
-            self.con = Phabricator(
+            self.con = phabricator.Phabricator(
                 token=kwargs['token'],
                 host=kwargs['host'],
-                timeout=kwargs['timeout']
+                timeout=kwargs['timeout'],
+                interface=interface(),
             )
+            # sees each response body before it is parsed
+            self.con.formats = {'json': self.parse_response}
         else:
             self.con = None
 
+        # query_delay is the historical way to throttle and
+        # stands in for a rate when none is configured
+        query_delay = kwargs.get('query_delay', .5)
+        self.limiter = ratelimit.get(
+            kwargs['host'],
+            kwargs.get('rate', 1 / query_delay if query_delay else 0),
+            kwargs.get('burst', 5)
+        )
+
+    def refresh(self):
+        """ forget fetched tasks so the next report asks again
+        Connections, stores and user and project lookups are kept,
+        so with a cache only what changed since is fetched.
+        """
+        with self.lock:
+            self.task_history = {}
+            self.boards = {}
+            self.columns = {}
+            self.assigned = {}
+
     def logging(self, msg):
         if self.logger:
             self.logger.debug(msg)
             return
         print(msg)
 
+    def call(self, method, **kwargs):
+        """ make a rate limited conduit call
+        :param method: str of conduit method e.g. 'maniphest.search'
+        :return: conduit result
+        """
+        function = self.method(method)
+        if self.tape:
+            # results wrap plain json which is what gets stored and
+            # replayed, so recording hands callers the same thing
+            conduit = function
+            function = functools.partial(self.tape.call, method, kwargs, lambda **kw: conduit(**kw).response)
+            if self.tape.mode == 'replay':
+                # answered from disk so there is nothing to throttle
+                return metrics.call('phab', method, function, **kwargs)
+        return self.limiter.call(metrics.call, 'phab', method, function, **kwargs)
+
+    def method(self, method):
+        """ the client resource for a conduit method
+        Resolving one builds a resource with its own http session at
+        every step, so each is resolved once and its connections are
+        kept alive for the following calls.
+        :param method: str of conduit method e.g. 'maniphest.search'
+        :return: callable resource
+        """
+        with self.methods_lock:
+            if method not in self.methods:
+                function = self.con
+                for attr in method.split('.'):
+                    function = getattr(function, attr)
+                self.methods[method] = function
+            return self.methods[method]
+
+    def lookup(self, kind, key, fetch):
+        """ fetch through the directory when one is configured
+        :param kind: str of what is looked up e.g. 'projects'
+        :param key: str naming the lookup
+        :param fetch: callable making the conduit calls
+        :return: value
+        """
+        if not self.directory:
+            return fetch()
+        return self.directory.lookup('phab/' + kind, key, self.directory_ttl, fetch)
+
+    def parse_response(self, text):
+        """ decode a conduit response noting its size
+        :param text: str of response body
+        :return: dict
+        """
+        metrics.receive(len(text))
+        return json.loads(text)
+
     def me(self):
-        return self.con.user.whoami()
+        return self.call('user.whoami')
 
     def generate_project_link(self, project):
         return self.project_fmt.format(project)
 
     def generate_task_link(self, task):
-        return self.task_fmt.format(task['id']), task['fields']['name']
+        return self.task_fmt.format(task.id), task.name
+
+    def to_task(self, task):
+        """ convert a maniphest.search result into a compact record
+        :param task: phab task dict
+        :return: Task
+        """
+        fields = task['fields']
+        attachments = task.get('attachments', {})
 
-    def page_query(
+        columns = util.safeget(attachments, ('columns', 'boards')) or {}
+        # conduit encodes an empty map as a list
+        if columns:
+            columns = [c['phid'] for b in columns.values() for c in b['columns']]
+
+        return Task(
+            backend='phab',
+            key=task['phid'],
+            id=task['id'],
+            name=fields['name'],
+            created=fields['dateCreated'],
+            modified=fields['dateModified'],
+            owner=fields['ownerPHID'],
+            status=util.safeget(fields, ('status', 'value')),
+            priority=util.safeget(fields, ('priority', 'name')),
+            subtype=fields.get('subtype'),
+            projects=tuple(util.safeget(attachments, ('projects', 'projectPHIDs')) or ()),
+            columns=frozenset(columns),
+        )
+
+    def paginate(
         self,
-        function,
+        method,
         queryKey='open',
         order=None,
         limit=100,
         constraints={},
-        query_delay=.5
+        attachments=None
     ):
-        """ Query paged results until
+        """ Yield each page of a paged search as it arrives
+        The next page is requested in the background while the
+        caller works on the current one, unless the backend is set
+        with prefetch False as when profiling the caller's thread.
+        :param method: str of conduit search method
         :param queryKey: string for main query modifyer
         :param order: string or None for result ordering
         :param limit: per query result limit #note this seems broken after 2
         :param constraints: dict of query modifiers
+        :param attachments: dict of attachments to include
+        :return: generator of task lists
         """
-        total_results = []
-        result = function(queryKey=queryKey, order=order, limit=limit,
-                          constraints=constraints)
-        while 1:
-            total_results += result['data']
-            after = result['cursor']['after']
-            result = function(queryKey=queryKey, order=order, limit=limit, after=after,
-                              constraints=constraints)
-            if result['cursor']['after'] is None:
-                break
-            time.sleep(query_delay)
-        return total_results
+        query = {
+            'queryKey': queryKey,
+            'order': order,
+            'limit': limit,
+            'constraints': constraints,
+        }
+        if attachments:
+            query['attachments'] = attachments
+
+        if not self.args.get('prefetch', True):
+            after = None
+            while True:
+                result = self.call(method, **(dict(query, after=after) if after else query))
+                metrics.page('phab', method)
+                after = result['cursor']['after']
+                yield result['data']
+                if after is None:
+                    return
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        pending = executor.submit(self.call, method, **query)
+        try:
+            while pending:
+                result = pending.result()
+                metrics.page('phab', method)
+                after = result['cursor']['after']
+                if after is None:
+                    pending = None
+                else:
+                    pending = executor.submit(self.call, method, after=after, **query)
+                yield result['data']
+        finally:
+            if pending:
+                pending.cancel()
+            executor.shutdown(wait=False)
 
     def get_member_info(self, realname, username, agents=False):
-        details = self.con.user.query(usernames=[username])[0]
-        if not agents and 'agent' in details['roles']:
-            print('Ignore agent {}'.format(details))
-            return {}
-        return details
+        return self.get_members_info({realname: username}, agents)[realname]
+
+    def get_members_info(self, usernames, agents=False, batch=100):
+        """ resolve many users with as few user.query calls as possible
+        :param usernames: dict of report name to phab username
+        :param agents: bool to include bot accounts
+        :param batch: int of usernames per call
+        :return: dict of report name to user details
+        """
+        wanted = sorted(set(usernames.values()))
+        found = dict((u, self.known_users[u]) for u in wanted if u in self.known_users)
+        if self.directory:
+            for username in wanted:
+                if username in found:
+                    continue
+                details = self.directory.get('phab/user', username, self.directory_ttl)
+                if details is not None:
+                    found[username] = details
+
+        missing = [u for u in wanted if u not in found]
+        for i in range(0, len(missing), batch):
+            chunk = missing[i:i + batch]
+            for details in self.call('user.query', usernames=chunk, limit=len(chunk)):
+                found[details['userName']] = details
+                if self.directory:
+                    self.directory.put('phab/user', details['userName'], details)
+        self.known_users.update(found)
+
+        members = {}
+        for realname, username in usernames.items():
+            if username not in found:
+                raise Exception('Invalid user: "{} ({})"'.format(username, realname))
+            details = found[username]
+            if not agents and 'agent' in details['roles']:
+                print('Ignore agent {}'.format(details))
+                details = {}
+            members[realname] = details
+        return members
 
     def user_info(self, phid):
-        return self.con.user.query(phids=[phid])[0]
+        return self.call('user.query', phids=[phid])[0]
 
-    def user_assigned(self, user_details):
-        assigned = self.con.maniphest.search(
-            queryKey='open',
-            attachments={"projects": True},
-            constraints={'assigned': [user_details['phid']]}
-        )
-        return assigned['data']
+    def user_key(self, user_details):
+        """ what a task's owner is set to for a user
+        :param user_details: dict as returned by get_member_info
+        :return: str of phid
+        """
+        return user_details['phid']
 
-    def task_mod_after_date(self, tasks, age):
-        modded = []
-        for task in tasks:
-            if task['fields']['dateModified'] < time.time() - age:
-                modded.append(task)
+    def project_keys(self, names):
+        """ phids of projects by name for antipattern rules
+        :param names: list of project names
+        :return: dict of lower cased name to phid
+        """
+        key = json.dumps(sorted(names))
+        with self.lock:
+            if key not in self.project_details:
+                self.project_details[key] = self.lookup(
+                    'projects',
+                    key,
+                    lambda: dict(self.call('project.query', names=names))
+                )
+        # conduit encodes an empty map as a list
+        data = self.project_details[key]['data'] or {}
+        return dict((p['name'].lower(), phid) for phid, p in data.items())
 
-        return sorted(modded, key=lambda i: i['fields']['dateModified'])
+    def user_assigned(self, user_details, projects=None):
+        return self.users_assigned([user_details])[0]
 
-    def task_created_after_date(self, tasks, age):
-        created_after = []
-        for task in tasks:
-            if task['fields']['dateCreated'] > age:
-                created_after.append(task)
+    def users_assigned(self, users_details, projects=None):
+        """ get open assigned tasks for many users from one paged search
+        :param users_details: list of user details dicts
+        :param projects: unused, every open task a user has counts
+                         whatever project it is on
+        :return: list of task lists in the order of users_details
+        """
+        phids = [u['phid'] for u in users_details if u and u['phid'] not in self.assigned]
+        assigned = dict((phid, []) for phid in phids)
+        if phids:
+            for page in self.paginate(
+                'maniphest.search',
+                constraints={'assigned': phids},
+                attachments={'projects': True}
+            ):
+                for task in map(self.to_task, page):
+                    assigned.setdefault(task.owner, []).append(task)
+        self.assigned.update(assigned)
+        return [self.assigned[u['phid']] if u else [] for u in users_details]
 
-        return sorted(created_after, key=lambda i: i['fields']['dateCreated'])
+    def task_created_after_date(self, tasks, age):
+        return timeindex.index(tasks).created_after(age)
 
     def get_tasks_created_since(self, project, days):
         """ get tasks from last n days with summary stats
@@ -110,51 +347,109 @@ class Status:
         :return: task list
         """
         start_date = int(time.time()) - (days * 86400)
-        if project in self.task_history and start_date > self.task_history[project]['start_date']:
+        if project in self.task_history and start_date >= self.task_history[project]['start_date']:
             self.logging('return cached for {} {}'.format(project, days))
             cached_tasks = self.task_history[project]['tasks']
             return self.task_created_after_date(cached_tasks, start_date)
 
-        tasks = self.page_query(
-            function=self.con.maniphest.search,
-            queryKey='all',
-            order='closed',
-            constraints={'projects': [project], 'createdStart': start_date},
-            query_delay=1
-        )
+        if self.cache:
+            tasks = self.sync_project(project, start_date)
+        else:
+            tasks = []
+            for page in self.paginate(
+                'maniphest.search',
+                queryKey='all',
+                order='closed',
+                constraints={'projects': [project], 'createdStart': start_date}
+            ):
+                tasks += map(self.to_task, page)
 
         if project not in self.task_history:
             self.task_history[project] = {}
         self.task_history[project]['start_date'] = start_date
-        self.task_history[project]['tasks'] = tasks
+        self.task_history[project]['tasks'] = timeindex.TimeIndex(tasks)
         return tasks
 
+    def sync_project(self, project, start_date):
+        """ bring the on disk store for a project up to date
+        Only tasks modified since the stored watermark are requested
+        unless the window now reaches back further than what is stored.
+        Tasks that drop the project tag are not seen by the project
+        constrained query and linger until the store is removed.
+        :param project: str
+        :param start_date: int epoch of earliest creation time wanted
+        :return: task list created since start_date
+        """
+        state = self.cache.sync_state(project)
+        if state and state[0] <= start_date:
+            start, watermark = state
+            constraints = {'projects': [project], 'modifiedStart': int(watermark)}
+            self.logging('{} syncing tasks modified since {}'.format(project, watermark))
+        else:
+            start, watermark = start_date, start_date
+            constraints = {'projects': [project], 'createdStart': start_date}
+            self.logging('{} syncing tasks created since {}'.format(project, start_date))
+
+        changed = []
+        for page in self.paginate('maniphest.search', queryKey='all', constraints=constraints):
+            for task in page:
+                fields = task['fields']
+                watermark = max(watermark, fields['dateModified'])
+                changed.append((task['phid'], fields['dateCreated'], fields['dateModified'], task))
+
+        self.logging('{} synced {} changed tasks'.format(project, len(changed)))
+        self.cache.update(project, changed, start, watermark)
+        return [self.to_task(t) for t in self.cache.tasks(project, start_date)]
+
     def tasks_summary(self, tasks, enabled_fields):
         """ returns a dict of summary info about a list of tasks
         :param tasks: list
         :return: list of summary dicts by summary_field
         """
-        summary = {}
+        return self.tasks_summaries(tasks, {None: len(tasks)}, enabled_fields)[None]
+
+    def tasks_summaries(self, tasks, windows, enabled_fields):
+        """ summary info for nested windows of a task list in one pass
+        :param tasks: list covering the widest window
+        :param windows: dict of window to the number of newest tasks it covers
+        :return: dict of window to summary dicts by summary_field
+        """
         summary_fields = {
-            'priority': ('fields', 'priority', 'name'),
-            'status': ('fields', 'status', 'value'),
-            'issue type': ('fields', 'subtype'),
+            'priority': 'priority',
+            'status': 'status',
+            'issue type': 'subtype',
         }
+        fields = dict((f, k) for f, k in summary_fields.items() if f in enabled_fields)
 
         # return count(s) of unique summary_field items for all tasks
-        for field, key in summary_fields.items():
+        summaries = summary.summarize(tasks, windows, fields)
+        for counts in summaries.values():
+            for field, values in counts.items():
+                if not any(values):
+                    counts[field] = {}
+        return summaries
 
-            if field not in enabled_fields:
-                continue
+    def board_tasks(self, project):
+        """ Get open tasks of a project with the columns attachment
+        Fetched once per project so every column is split from the
+        same snapshot of the board.
+        :param project: str
+        :return: list
+        """
+        with self.lock:
+            lock = self.board_locks.setdefault(project, threading.Lock())
 
-            extracted_fields = []
-            for task in tasks:
-                extracted_fields.append(util.safeget(task, key))
-            if any(extracted_fields):
-                summary[field] = dict(Counter(extracted_fields))
-            else:
-                summary[field] = {}
-        return summary
+        with lock:
+            if project not in self.boards:
+                tasks = []
+                for page in self.paginate(
+                    'maniphest.search',
+                    constraints={'projects': [project]},
+                    attachments={'columns': True, 'projects': True}
+                ):
+                    tasks += map(self.to_task, page)
+                self.boards[project] = tasks
+        return self.boards[project]
 
     def column_tasks(self, column, project):
         """ Get tasks by workboard column
@@ -162,41 +457,16 @@ class Status:
         :param project: str
         :return: list
         """
-        return self.page_query(
-            function=self.con.maniphest.search,
-            constraints={'columnPHIDs': [column]}
-        )
+        if self.args.get('board_snapshot'):
+            return [t for t in self.board_tasks(project) if column in t.columns]
 
-    def anti_punassigned(self, antinfo, pinfo):
-        """ return a list of tasks that are in progress but unassigned
-        :param tasks_dict: list of standard phab task dicts
-        """
-        tasks_dict = pinfo['columns']['progress']
-
-        punassigned = []
-        for task in tasks_dict:
-            if task['fields']['ownerPHID'] is None:
-                punassigned.append(task)
-        return punassigned
-
-    def anti_watching_dormant(self, antinfo, pinfo):
-        tasks_dict = pinfo['columns']['watching']
-        best_by_date = antinfo['age']
-        return self.task_mod_after_date(tasks_dict, best_by_date)
-
-    def anti_moldy(self, tasks, antinfo, beinfo):
-        best_by_date = antinfo['age']
-        return self.task_mod_after_date(tasks, best_by_date)
-
-    def anti_assigned_wo_reporting_project(self, tasks, antinfo, beinfo):
-        if not self.project_details:
-            self.project_details = self.con.project.query(names=list(beinfo['projects'].keys()))
-        reported_phids = set(self.project_details['data'].keys())
-
-        out = []
-        for task in tasks:
-            task_projects = task['attachments']['projects']['projectPHIDs']
-            matched = set(task_projects).intersection(reported_phids)
-            if not matched:
-                out.append(task)
-        return out
+        if column not in self.columns:
+            tasks = []
+            for page in self.paginate(
+                'maniphest.search',
+                constraints={'columnPHIDs': [column]},
+                attachments={'projects': True}
+            ):
+                tasks += map(self.to_task, page)
+            self.columns[column] = tasks
+        return self.columns[column]
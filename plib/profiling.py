@@ -0,0 +1,128 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+
+from plib import metrics
+
+
+class Profiler:
+    """ cpu profile and memory of every top level stage
+    Only one cProfile profiler can watch a thread at a time so
+    stages nested inside another are part of its profile rather
+    than profiled on their own, and only the main thread is watched.
+    Stages only note the traced memory size and peak as snapshots
+    of every allocation take longer than the stages themselves, so
+    allocation sites are compared once for the whole run on request.
+    """
+    def __init__(self, directory, top=30, allocations=False):
+        """
+        :param directory: str where reports are written
+        :param top: int of functions and allocation sites listed
+        :param allocations: bool to write the allocation sites the
+                            run grew by
+        """
+        self.directory = directory
+        self.top = top
+        self.depth = 0
+        self.written = []
+        os.makedirs(directory, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(1)
+        self.first = self.snapshot() if allocations else None
+
+    def filename(self, name):
+        """ a numbered file name safe for any stage name
+        :param name: str of stage name
+        :return: str of path without extension
+        """
+        safe = re.sub(r'[^\w.-]+', '_', name).strip('_')
+        return os.path.join(self.directory, '{:02d}-{}'.format(len(self.written) + 1, safe))
+
+    def start(self, name):
+        if threading.current_thread() is not threading.main_thread():
+            return
+        self.depth += 1
+        if self.depth > 1:
+            return
+        self.before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        self.started = time.monotonic()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self, name):
+        if threading.current_thread() is not threading.main_thread():
+            return
+        self.depth -= 1
+        if self.depth:
+            return
+        self.profile.disable()
+        elapsed = time.monotonic() - self.started
+        size, peak = tracemalloc.get_traced_memory()
+
+        path = self.filename(name)
+        self.profile.dump_stats(path + '.pstats')
+
+        out = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        with open(path + '.txt', 'w') as f:
+            f.write(out.getvalue())
+
+        self.written.append({
+            'stage': name,
+            'path': path,
+            'seconds': round(elapsed, 4),
+            'peak': peak,
+            'allocated': size - self.before,
+        })
+
+    @staticmethod
+    def snapshot():
+        """ allocations so far leaving out the tracing itself
+        :return: tracemalloc.Snapshot
+        """
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, pstats.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ])
+
+    def close(self):
+        """ stop watching stages and write an index of every report """
+        if self in metrics.observers:
+            metrics.observers.remove(self)
+        if self.first is not None:
+            growth = self.snapshot().compare_to(self.first, 'lineno')
+            with open(os.path.join(self.directory, 'allocations.txt'), 'w') as f:
+                for diff in growth[:self.top]:
+                    f.write('{}\n'.format(diff))
+        tracemalloc.stop()
+        with open(os.path.join(self.directory, 'index.txt'), 'w') as f:
+            f.write('{:<40} {:>10} {:>12} {:>12}\n'.format('stage', 'seconds', 'peak kB', 'grew kB'))
+            for info in self.written:
+                f.write('{:<40} {:>10} {:>12} {:>12}\n'.format(
+                    os.path.basename(info['path']),
+                    info['seconds'],
+                    info['peak'] // 1024,
+                    info['allocated'] // 1024,
+                ))
+
+
+def enable(directory, allocations=False):
+    """ profile every top level stage from now on
+    :param directory: str where reports are written
+    :param allocations: bool to also write the allocation sites
+                        the whole run grew by
+    :return: Profiler
+    """
+    profiler = Profiler(directory, allocations=allocations)
+    metrics.observers.append(profiler)
+    return profiler
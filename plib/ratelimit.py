@@ -0,0 +1,126 @@
+import re
+import threading
+import time
+
+
+# one limiter per backend host shared by every caller in the process
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def get(host, rate, burst):
+    """ get the shared limiter for a host
+    :param host: str of backend host
+    :param rate: float of requests per second (0 is unlimited)
+    :param burst: int of requests allowed back to back
+    :return: TokenBucket
+    """
+    with limiters_lock:
+        if host not in limiters:
+            limiters[host] = TokenBucket(rate, burst)
+        return limiters[host]
+
+
+def rate_limited(e):
+    """ whether an exception is the server asking us to slow down
+    :param e: Exception
+    :return: bool
+    """
+    # asana errors carry the status, phabricator only has the message
+    if getattr(e, 'status', None) == 429:
+        return True
+    return bool(re.search(r'\b429\b|rate.?limit', str(e), re.IGNORECASE))
+
+
+def server_error(e):
+    """ whether an exception is a transient failure of the server
+    :param e: Exception
+    :return: bool
+    """
+    status = getattr(e, 'status', None) or getattr(getattr(e, 'response', None), 'status_code', None)
+    if isinstance(status, int):
+        return status >= 500
+    # phabricator only has the message, e.g. 'Bad response status: 503'
+    return bool(re.search(r'\bstatus:?\s*5\d\d\b', str(e), re.IGNORECASE))
+
+
+class TokenBucket:
+    """adaptive token bucket
+
+    Tokens refill at the current rate up to burst.  Each rate
+    limit response halves the current rate and pauses all callers,
+    each success recovers a tenth of the configured rate.  Server
+    errors are retried too, backing off only the caller that hit one.
+    """
+    def __init__(self, rate, burst, retries=5):
+        self.rate = float(rate)
+        self.current = self.rate
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self.stamp = time.monotonic()
+        self.paused_until = 0
+        self.retries = retries
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ block until a request may be made """
+        if not self.rate:
+            # unlimited, but a rate limit response still pauses everyone
+            with self.lock:
+                wait = self.paused_until - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.current)
+                self.stamp = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.current
+            time.sleep(wait)
+
+    def backoff(self, retry_after=None):
+        """ slow down after a rate limit response
+        :param retry_after: seconds the server asked us to wait
+        """
+        with self.lock:
+            if self.rate:
+                self.current = max(self.rate / 64, self.current / 2)
+            self.tokens = 0
+            delay = retry_after or (1 / self.current if self.rate else 1)
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def recover(self):
+        """ creep back up to the configured rate after a success """
+        if self.current < self.rate:
+            with self.lock:
+                self.current = min(self.rate, self.current + self.rate / 10)
+
+    def call(self, function, *args, **kwargs):
+        """ make a throttled call retrying when rate limited or the
+        server fails
+        :param function: callable making one request
+        :return: result of function
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.retries or not (rate_limited(e) or server_error(e)):
+                    raise
+                attempt += 1
+                if rate_limited(e):
+                    self.backoff(getattr(e, 'retry_after', None))
+                else:
+                    time.sleep(min(30, 2 ** (attempt - 1)))
+                continue
+            self.recover()
+            return result
@@ -0,0 +1,255 @@
+# what the original anti_* backend methods checked so configs
+# naming a method rather than declaring a rule keep working
+METHODS = {
+    'anti_punassigned': lambda antinfo: {'column': 'progress', 'owner': False},
+    'anti_watching_dormant': lambda antinfo: {'column': 'watching', 'age': antinfo['age']},
+    'anti_moldy': lambda antinfo: {'age': antinfo['age']},
+    'anti_assigned_wo_reporting_project': lambda antinfo: {'reporting': False},
+}
+
+TAG_TESTS = ('any', 'all', 'none', 'exclusive')
+
+
+def listed(value):
+    """ a config value that may be one item or several
+    :param value: item or list of items
+    :return: list
+    """
+    return list(value) if isinstance(value, (list, tuple, set)) else [value]
+
+
+# Each predicate takes its config value and the evaluation context
+# and returns a test of a Task.  Tests read the task as it is so
+# checking one allocates nothing, which adds up over a large board.
+
+def owner(value, context):
+    value = bool(value)
+    return lambda task: (task.owner is not None) == value
+
+
+def age(value, context):
+    before = context['now'] - value
+    return lambda task: task.modified < before
+
+
+def assignee(value, context):
+    owners = context['owners']
+    if isinstance(value, bool):
+        return lambda task: (task.owner in owners) == value
+    keys = set(k for k, user in owners.items() if user in listed(value))
+    return lambda task: task.owner in keys
+
+
+def reporting(value, context):
+    value = bool(value)
+    keys = context['reporting']
+    return lambda task: (not keys.isdisjoint(task.projects or ())) == value
+
+
+def tags(value, context):
+    keys = context['tags']
+
+    def resolve(names):
+        names = [n.lower() for n in listed(names)]
+        return frozenset(keys[n] for n in names if n in keys), len(names)
+
+    tests = []
+    if 'any' in value:
+        wanted, _ = resolve(value['any'])
+        tests.append(lambda projects: not wanted.isdisjoint(projects))
+    if 'all' in value:
+        required, count = resolve(value['all'])
+        # a project that does not exist is on no task
+        complete = len(required) == count
+        tests.append(lambda projects: complete and required.issubset(projects))
+    if 'none' in value:
+        unwanted, _ = resolve(value['none'])
+        tests.append(lambda projects: unwanted.isdisjoint(projects))
+    if 'exclusive' in value:
+        exclusive, _ = resolve(value['exclusive'])
+        tests.append(lambda projects: len(exclusive.intersection(projects)) > 1)
+    return lambda task: all(test(task.projects or ()) for test in tests)
+
+
+# column is checked once per set of columns tasks are in, see Rule.bind
+PREDICATES = {
+    'column': None,
+    'owner': owner,
+    'age': age,
+    'assignee': assignee,
+    'reporting': reporting,
+    'tags': tags,
+}
+
+
+class Rule:
+    """an antipattern as predicates a task has to meet all of
+
+    A rule is declared in config with a where of field to value:
+
+    column: workboard column name or list of them the task is in
+    owner: True when the task has to be assigned, False unassigned
+    age: seconds since the task was last modified, at least
+    assignee: True for tasks assigned to a report user, False for
+              anyone else, or a report user name or list of them
+    reporting: False for tasks on none of the backend's projects
+    tags: project names with any, all, none, or exclusive for
+          tasks on more than one of them
+    """
+    def __init__(self, antinfo):
+        """
+        :param antinfo: dict of name, show and where or method
+        """
+        self.name = antinfo['name']
+        self.show = antinfo.get('show', 3)
+        if 'where' in antinfo:
+            self.where = antinfo['where']
+        elif antinfo.get('method') in METHODS:
+            self.where = METHODS[antinfo['method']](antinfo)
+        else:
+            raise Exception('Antipattern "{}" needs a where or a known method'.format(self.name))
+
+        for field, value in self.where.items():
+            if field not in PREDICATES:
+                raise Exception('Unknown field "{}" in antipattern "{}"'.format(field, self.name))
+            if field == 'tags' and (not isinstance(value, dict) or set(value) - set(TAG_TESTS)):
+                raise Exception('Antipattern "{}" tags takes {}'.format(self.name, ', '.join(TAG_TESTS)))
+        self.by_age = 'age' in self.where
+
+    def tag_names(self):
+        """ project names the rule refers to
+        :return: set of str
+        """
+        names = set()
+        for value in self.where.get('tags', {}).values():
+            names.update(listed(value))
+        return names
+
+    def needs_projects(self):
+        return 'tags' in self.where or 'reporting' in self.where
+
+    def bind(self, context):
+        """ the checks of the rule for one evaluation
+        Columns are kept apart as every task in the same columns
+        passes or fails them alike, so they are checked per set
+        of columns rather than per task.
+        :param context: dict as for evaluate
+        :return: tuple of set of column names or None for any column,
+                 and callable of Task or None when nothing else is checked
+        """
+        columns = set(listed(self.where['column'])) if 'column' in self.where else None
+        tests = [PREDICATES[field](value, context) for field, value in self.where.items() if field != 'column']
+        if len(tests) < 2:
+            return columns, tests[0] if tests else None
+
+        def test(task):
+            for check in tests:
+                if not check(task):
+                    return False
+            return True
+        return columns, test
+
+
+def load(antis):
+    """ rules from an anti section of the config
+    :param antis: dict of key to antipattern config
+    :return: list of Rule in config order
+    """
+    return [Rule(antinfo) for antinfo in antis.values()]
+
+
+def applicable(bound, columns, checks):
+    """ the rules whose columns a task meets
+    :param bound: list of tuples as returned by Rule.bind
+    :param columns: frozenset of column names the task is in
+    :param checks: dict kept between calls of columns to the result
+    :return: list of (rule index, test or None)
+    """
+    if columns not in checks:
+        checks[columns] = [
+            (i, test) for i, (names, test) in enumerate(bound)
+            if names is None or not names.isdisjoint(columns)
+        ]
+    return checks[columns]
+
+
+def evaluate(project_rules, user_rules, projects, assigned, context):
+    """ check every rule against the tasks they cover in one pass
+    Project rules see the tasks on each project's board columns and
+    user rules the tasks assigned to each user.  Each task is tested
+    against all the rules of its scope at once.
+    :param project_rules: list of Rule
+    :param user_rules: list of Rule
+    :param projects: dict of project to dict of 'columns' of
+                     column name to task list
+    :param assigned: dict of user to task list
+    :param context: dict of
+                    now: epoch rule ages count back from
+                    owners: dict of owner key to report user name
+                    tags: dict of lower cased project name to key
+                    reporting: set of keys of the backend's projects
+    :return: tuple of list of (project, Rule, task list) by project
+             then rule, and dict of user to list of (Rule, task list)
+    """
+    project_tests = [rule.bind(context) for rule in project_rules]
+    user_tests = [rule.bind(context) for rule in user_rules]
+
+    # boards are walked for the columns rules name, or whole when
+    # a project rule holds for a task in any column
+    named = set()
+    for rule in project_rules + user_rules:
+        named.update(listed(rule.where.get('column', ())))
+    walk = None if any('column' not in rule.where for rule in project_rules) else named
+
+    # the tasks of each board and the columns each is in, sharing one
+    # set per column as most tasks are in a single column
+    boards = {}
+    single = {}
+    for project, pinfo in projects.items() if walk is None or walk else ():
+        on_board, columns_of = boards[project] = ({}, {})
+        for name, tasks in pinfo['columns'].items():
+            if walk is not None and name not in walk:
+                continue
+            only = single.setdefault(name, frozenset([name]))
+            for task in tasks:
+                on_board[task.key] = task
+                columns_of[task.key] = columns_of[task.key] | only if task.key in columns_of else only
+
+    found = []
+    checks = {}
+    for project, (on_board, columns_of) in boards.items():
+        matches = [[] for _ in project_tests]
+        for key, task in on_board.items():
+            for i, test in applicable(project_tests, columns_of[key], checks):
+                if test is None or test(task):
+                    matches[i].append(task)
+        found += [(project, rule, tasks) for rule, tasks in zip(project_rules, matches)]
+
+    # a user's task may be on several of the boards
+    columns_any = {}
+    if any('column' in rule.where for rule in user_rules):
+        for on_board, columns_of in boards.values():
+            for key, columns in columns_of.items():
+                columns_any[key] = columns_any[key] | columns if key in columns_any else columns
+
+    user_found = {}
+    checks = {}
+    none = frozenset()
+    for user, tasks in assigned.items():
+        matches = [[] for _ in user_tests]
+        for task in tasks if user_tests else ():
+            for i, test in applicable(user_tests, columns_any.get(task.key, none), checks):
+                if test is None or test(task):
+                    matches[i].append(task)
+        user_found[user] = list(zip(user_rules, matches))
+
+    # the longest untouched tasks are the ones worth listing first
+    for _, rule, tasks in found:
+        if rule.by_age:
+            tasks.sort(key=lambda t: t.modified)
+    for matches in user_found.values():
+        for rule, tasks in matches:
+            if rule.by_age:
+                tasks.sort(key=lambda t: t.modified)
+
+    return found, user_found
@@ -0,0 +1,132 @@
+import datetime
+import logging
+import threading
+import time
+
+
+# (lowest, highest) of minute, hour, day of month, month and weekday
+FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+def parse_field(expr, low, high):
+    """ values allowed by one crontab field
+    :param expr: str such as '*', '*/15', '1-5' or '0,30'
+    :param low: int lowest value of the field
+    :param high: int highest value of the field
+    :return: set of int
+    """
+    allowed = set()
+    for part in expr.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(v) for v in part.split('-'))
+        else:
+            start = end = int(part)
+        if start < low or end > high or start > end or step < 1:
+            raise Exception('Invalid schedule field "{}"'.format(expr))
+        allowed.update(range(start, end + 1, step))
+    return allowed
+
+
+class Cron:
+    """minute hour day month weekday schedule as in a crontab
+
+    Weekdays count from 0 for Sunday (7 is Sunday too).  As in cron
+    a restricted day of month and weekday match when either does.
+    """
+    def __init__(self, expr):
+        parts = str(expr).split()
+        if len(parts) != 5:
+            raise Exception('Invalid schedule "{}"'.format(expr))
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            parse_field(p, low, high) for p, (low, high) in zip(parts, FIELDS)
+        )
+        self.weekdays = set(d % 7 for d in weekdays)
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+    def day_matches(self, when):
+        day = when.day in self.days
+        weekday = (when.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next(self, after):
+        """ first matching minute after a time
+        :param after: epoch
+        :return: epoch
+        """
+        when = datetime.datetime.fromtimestamp(after).replace(second=0, microsecond=0)
+        when += datetime.timedelta(minutes=1)
+        # any schedule matches within a few years, a leap day at most
+        limit = when + datetime.timedelta(days=366 * 5)
+        while when < limit:
+            if when.month not in self.months:
+                when = (when.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(when):
+                when = when.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif when.hour not in self.hours:
+                when = when.replace(minute=0) + datetime.timedelta(hours=1)
+            elif when.minute not in self.minutes:
+                when += datetime.timedelta(minutes=1)
+            else:
+                return when.timestamp()
+        raise Exception('Schedule "{}" never runs'.format(self.expr))
+
+
+class Scheduler:
+    """run functions when their schedules come due
+
+    Everything runs one at a time on the thread calling run so
+    scheduled work never overlaps.  A failure is logged and the
+    function runs again at its next time.
+    """
+    def __init__(self):
+        self.entries = []
+        self.stopped = threading.Event()
+
+    def add(self, name, cron, function):
+        """
+        :param name: str for logging
+        :param cron: Cron or crontab str
+        :param function: callable taking no arguments
+        """
+        cron = cron if isinstance(cron, Cron) else Cron(cron)
+        self.entries.append({
+            'name': name,
+            'cron': cron,
+            'function': function,
+            'due': cron.next(time.time()),
+        })
+
+    def run_pending(self):
+        """ run every entry that is due, in the order they were added """
+        for entry in self.entries:
+            if entry['due'] > time.time():
+                continue
+            logging.info('Running scheduled {}'.format(entry['name']))
+            try:
+                entry['function']()
+            except Exception:
+                logging.exception('Scheduled {} failed'.format(entry['name']))
+            entry['due'] = entry['cron'].next(time.time())
+
+    def run(self):
+        """ run due entries until stop is called """
+        while not self.stopped.is_set():
+            self.run_pending()
+            if self.entries:
+                wait = min(e['due'] for e in self.entries) - time.time()
+                self.stopped.wait(max(0, min(wait, 60)))
+            else:
+                self.stopped.wait(60)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,71 @@
+from array import array
+
+
+class SummaryMatrix:
+    """summary counts of every project held as one columnar matrix
+
+    Each summary field keeps a column per value seen and each column
+    is an array of counts with a row for every (project, duration).
+    Project tables, backend totals and report totals are slices or
+    sums of the same columns rather than rebuilt nested dicts.
+    """
+    def __init__(self, durations):
+        self.durations = sorted(durations, reverse=True)
+        self.projects = {}
+        self.fields = {}
+        self.field_projects = {}
+
+    def add(self, project, history):
+        """ add the summaries of a project
+        :param project: hashable project key such as (backend, name)
+        :param history: dict of duration to dict holding 'stats'
+        """
+        width = len(self.durations)
+        row = len(self.projects)
+        self.projects[project] = row
+        for columns in self.fields.values():
+            for column in columns.values():
+                column.frombytes(bytes(column.itemsize * width))
+
+        for i, duration in enumerate(self.durations):
+            for field, values in history[duration]['stats'].items():
+                columns = self.fields.setdefault(field, {})
+                self.field_projects.setdefault(field, set()).add(row)
+                for value, count in values.items():
+                    if value not in columns:
+                        columns[value] = array('q', bytes(8 * width * len(self.projects)))
+                    columns[value][row * width + i] = count
+
+    def rows(self, projects=None):
+        """ row numbers of projects
+        :param projects: list of project keys, all when None
+        :return: list of int
+        """
+        if projects is None:
+            return list(self.projects.values())
+        return [self.projects[p] for p in projects]
+
+    def reduce(self, projects=None):
+        """ counts summed over projects
+        :param projects: list of project keys, all when None
+        :return: dict of field to dict of value to counts by duration
+        """
+        width = len(self.durations)
+        rows = self.rows(projects)
+        single = len(rows) == 1
+
+        totals = {}
+        for field, columns in self.fields.items():
+            if not self.field_projects[field].intersection(rows):
+                continue
+
+            totals[field] = {}
+            for value, column in columns.items():
+                if single:
+                    start = rows[0] * width
+                    counts = column[start:start + width].tolist()
+                else:
+                    counts = [sum(column[r * width + i] for r in rows) for i in range(width)]
+                if any(counts):
+                    totals[field][value] = counts
+        return totals
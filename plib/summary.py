@@ -0,0 +1,23 @@
+def summarize(tasks, windows, fields):
+    """ count summary field values for nested windows in one pass
+    Every window covers the newest tasks of the one above it, so
+    walking tasks newest first with running counts hands each window
+    its totals as soon as the walk passes its last task.
+    :param tasks: list of Task covering the widest window
+    :param windows: dict of window to the number of newest tasks it covers
+    :param fields: dict of summary field to Task attribute
+    :return: dict of window to dict of field to value counts
+    """
+    newest = sorted(tasks, key=lambda t: t.created)[::-1]
+    counts = dict((field, {}) for field in fields)
+
+    summaries = {}
+    walked = 0
+    for window, size in sorted(windows.items(), key=lambda w: w[1]):
+        for task in newest[walked:size]:
+            for field, key in fields.items():
+                value = getattr(task, key)
+                counts[field][value] = counts[field].get(value, 0) + 1
+        walked = max(walked, size)
+        summaries[window] = dict((field, dict(c)) for field, c in counts.items())
+    return dict((window, summaries[window]) for window in windows)
@@ -0,0 +1,157 @@
+import gzip
+import json
+import os
+import threading
+
+
+# one tape per backend and directory shared by every caller in the process
+tapes = {}
+tapes_lock = threading.Lock()
+
+
+def key(endpoint, request):
+    """ a stable name for a request
+    :param endpoint: str of api method or path
+    :param request: dict of request arguments
+    :return: str
+    """
+    return json.dumps([endpoint, request], sort_keys=True, default=str)
+
+
+def shape(value):
+    """ a request with every number blanked out
+    Times such as conduit's createdStart are numbers worked out
+    from the clock so they differ between recording and replay.
+    :param value: request arguments
+    :return: the same structure with numbers as 0
+    """
+    if isinstance(value, dict):
+        return dict((k, shape(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [shape(v) for v in value]
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return 0
+    return value
+
+
+def get(backend, record=None, replay=None):
+    """ get the shared tape for a backend
+    :param backend: str of backend name
+    :param record: str of directory to write api traffic to
+    :param replay: str of directory to read api traffic from
+    :return: Tape or None when neither is asked for
+    """
+    if not record and not replay:
+        return None
+    if record and replay:
+        raise Exception('cannot record and replay at once')
+    directory = record or replay
+    with tapes_lock:
+        if (backend, directory) not in tapes:
+            tapes[(backend, directory)] = Tape(
+                os.path.join(directory, '{}.jsonl.gz'.format(backend)),
+                'record' if record else 'replay',
+            )
+        return tapes[(backend, directory)]
+
+
+def close():
+    """ finish writing every tape being recorded """
+    with tapes_lock:
+        for tape in tapes.values():
+            tape.close()
+        tapes.clear()
+
+
+class Tape:
+    """api requests and their responses as gzipped json lines
+
+    Replay answers each request with what was recorded for exactly
+    the same request.  Requests made relative to the current time
+    never match a recording made earlier, so those fall back to an
+    unused one that differs only in numbers.  Anything else was never
+    recorded and fails rather than being answered with the response
+    to some other request.
+    """
+    def __init__(self, path, mode):
+        """
+        :param path: str of tape file
+        :param mode: str of 'record' or 'replay'
+        """
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.out = None
+        self.exact = {}
+        self.shapes = {}
+        if mode == 'record':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.out = gzip.open(path, 'wt')
+            return
+
+        if not os.path.exists(path):
+            raise Exception('nothing recorded at {}'.format(path))
+        with gzip.open(path, 'rt') as f:
+            for n, line in enumerate(f):
+                entry = json.loads(line)
+                entry['n'] = n
+                self.exact.setdefault(key(entry['endpoint'], entry['request']), []).append(entry)
+                self.shapes.setdefault(key(entry['endpoint'], shape(entry['request'])), []).append(entry)
+        self.used = set()
+
+    def call(self, endpoint, request, function, *args, **kwargs):
+        """ make a request through the tape
+        :param endpoint: str of api method or path
+        :param request: dict of request arguments that name it
+        :param function: callable making the request when recording
+        :return: response
+        """
+        if self.mode == 'replay':
+            return self.replay(endpoint, request)
+
+        try:
+            response = function(*args, **kwargs)
+        except Exception as e:
+            self.write({'endpoint': endpoint, 'request': request, 'error': str(e)})
+            raise
+        self.write({'endpoint': endpoint, 'request': request, 'response': response})
+        return response
+
+    def write(self, entry):
+        line = json.dumps(entry, sort_keys=True, default=str)
+        with self.lock:
+            self.out.write(line + '\n')
+
+    def replay(self, endpoint, request):
+        """ answer a request from the recording
+        :param endpoint: str of api method or path
+        :param request: dict of request arguments
+        :return: recorded response
+        """
+        with self.lock:
+            entry = self.next(self.exact.get(key(endpoint, request), []))
+            if entry is None:
+                entry = self.next(self.shapes.get(key(endpoint, shape(request)), []), fresh=True)
+            if entry is None:
+                raise Exception('no recorded response for {} {}'.format(endpoint, request))
+            self.used.add(entry['n'])
+        if 'error' in entry:
+            raise Exception(entry['error'])
+        return entry['response']
+
+    def next(self, entries, fresh=False):
+        """ first unused entry, or the last one once all are used
+        :param entries: list of recorded entries
+        :param fresh: bool to never reuse an entry
+        :return: dict or None
+        """
+        for entry in entries:
+            if entry['n'] not in self.used:
+                return entry
+        return entries[-1] if entries and not fresh else None
+
+    def close(self):
+        with self.lock:
+            if self.out:
+                self.out.close()
+                self.out = None
@@ -0,0 +1,28 @@
+class Task:
+    """compact task record shared by the backends
+
+    Backends convert raw api results into these as they arrive and
+    keep only the fields the report and antipatterns read.
+    """
+    __slots__ = (
+        'backend',    # str of backend name
+        'key',        # native identity: phab PHID or asana gid
+        'id',         # shown identity: phab task number or asana gid
+        'name',
+        'created',    # epoch
+        'modified',   # epoch
+        'owner',      # phab owner PHID or asana assignee gid
+        'status',
+        'priority',
+        'subtype',
+        'completed',
+        'projects',   # tuple of project PHIDs or gids
+        'columns',    # frozenset of workboard column PHIDs
+    )
+
+    def __init__(self, **kwargs):
+        for field in self.__slots__:
+            setattr(self, field, kwargs.get(field))
+
+    def __repr__(self):
+        return 'Task({}:{} {})'.format(self.backend, self.id, self.name)
@@ -0,0 +1,29 @@
+class TaskStore:
+    """tasks held once by backend native id
+
+    Ids are (backend, Task.key) tuples so tasks from different
+    backends never collide.  Groups of tasks are handed out as
+    insertion ordered id sets (dicts with None values) so dedupe
+    and union are linear rather than comparing whole tasks.
+    """
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, tasks):
+        """ store tasks and get their ids
+        :param tasks: list of Task
+        :return: id set
+        """
+        ids = {}
+        for task in tasks:
+            key = (task.backend, task.key)
+            self.tasks.setdefault(key, task)
+            ids[key] = None
+        return ids
+
+    def get(self, ids):
+        """ get tasks back from ids
+        :param ids: id set or list of ids
+        :return: list of tasks
+        """
+        return [self.tasks[i] for i in ids]
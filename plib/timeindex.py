@@ -0,0 +1,48 @@
+import bisect
+import threading
+
+
+class TimeIndex:
+    """tasks sorted by creation time
+
+    Each ordering is sorted once on first use so every window
+    afterwards is a bisect and a slice rather than a scan and sort.
+    Iterating gives the tasks back in the order they were loaded.
+    """
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+        self.orders = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def order(self, field):
+        """ tasks sorted by a time field and the sorted times
+        :param field: str of 'created' or 'modified'
+        :return: tuple of (task list, epoch list)
+        """
+        with self.lock:
+            if field not in self.orders:
+                tasks = sorted(self.tasks, key=lambda t: getattr(t, field))
+                self.orders[field] = (tasks, [getattr(t, field) for t in tasks])
+            return self.orders[field]
+
+    def created_after(self, ctime):
+        """ tasks created after a time
+        :param ctime: epoch
+        :return: task list ordered by creation time
+        """
+        tasks, times = self.order('created')
+        return tasks[bisect.bisect_right(times, ctime):]
+
+
+def index(tasks):
+    """ index a task list unless it already is one
+    :param tasks: list of Task or TimeIndex
+    :return: TimeIndex
+    """
+    return tasks if isinstance(tasks, TimeIndex) else TimeIndex(tasks)
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -43,9 +44,16 @@ def safeget(dct, keys):
     return dct
 
 
-def dedupe_list_of_dicts(dicts):
-    """ unique a list of dicts
-    :param dicts: list
-    :return: list
+def pmap(function, items, workers=1):
+    """ map function over items using a bounded thread pool
+    :param function: callable taking a single item
+    :param items: iterable
+    :param workers: int of max concurrent calls (1 is serial)
+    :return: list of results in the order of items
     """
-    return [i for n, i in enumerate(dicts) if i not in dicts[n + 1:]]
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [function(i) for i in items]
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(function, items))
@@ -0,0 +1,126 @@
+import threading
+
+
+# one environment per template directory so each template is
+# compiled at most once per process and loaded from bytecode after
+environments = {}
+environments_lock = threading.Lock()
+
+
+def environment(templates, bytecode_cache=None):
+    """ get the shared environment for a template directory
+    :param templates: str of template directory
+    :param bytecode_cache: str of directory for compiled templates,
+                           by default a per user directory under /tmp
+    :return: jinja2.Environment
+    """
+    # jinja is only loaded once something is rendered
+    from jinja2 import Environment
+    from jinja2 import FileSystemBytecodeCache
+    from jinja2 import FileSystemLoader
+
+    with environments_lock:
+        if (templates, bytecode_cache) not in environments:
+            environments[(templates, bytecode_cache)] = Environment(
+                loader=FileSystemLoader(templates),
+                bytecode_cache=FileSystemBytecodeCache(bytecode_cache) if bytecode_cache else FileSystemBytecodeCache(),
+            )
+        return environments[(templates, bytecode_cache)]
+
+
+def summary_tables(tables):
+    """ flatten summary tables in the order they are shown
+    :param tables: dict of field to table as built by format.tasks_summary_table
+    :return: list of dicts of caption, header and (duration, counts) rows
+    """
+    return [
+        {
+            'caption': field.capitalize(),
+            'header': [h.capitalize() for h in table['header']],
+            'rows': sorted(table['durations'].items()),
+        }
+        for field, table in sorted(tables.items(), key=lambda t: t[0].lower(), reverse=True)
+    ]
+
+
+def build(meta, bes, cfg, total):
+    """ everything body.html shows with counts and links worked out
+    :param meta: dict of report metadata
+    :param bes: dict of backend results
+    :param cfg: dict of full config
+    :param total: dict of report totals
+    :return: dict
+    """
+    # jinja's sort ignores case for plain strings but not for items
+    backends = sorted(meta['enabled_backends'], key=str.lower)
+    show = cfg['users']['attributes']['show']
+    group = total['users']['group']
+
+    users = []
+    for user in sorted(cfg['users']['map'], key=str.lower):
+        per_backend = []
+        for be in backends:
+            uinfo = bes[be]['users'][user]
+            per_backend.append({
+                'name': be.capitalize(),
+                'assigned': len(uinfo['stats']['assigned']),
+                'antipatterns': [
+                    {
+                        'name': pattern.capitalize(),
+                        'count': len(groups['all']),
+                        'shown': groups['shown'],
+                    }
+                    for pattern, groups in sorted(uinfo.get('antipatterns', {}).items())
+                ],
+            })
+        users.append({
+            'name': user,
+            'image': bes[show['image']['backend']]['users'][user]['image'],
+            'uri': bes[show['uri']['backend']]['users'][user]['uri'],
+            'totals': [(t.capitalize(), len(v)) for t, v in sorted(total['users']['individual'][user]['stats'].items())],
+            'backends': per_backend,
+        })
+
+    return {
+        'sections': cfg['sections'],
+        'name': meta['name'],
+        'runtime': meta['runtime'],
+        'metrics': meta.get('metrics'),
+        'project_count': len(meta['enabled_projects']),
+        'backends': [
+            {
+                'name': be.capitalize(),
+                'projects': [(project, pinfo['show']['uri']) for project, pinfo in sorted(bes[be]['projects'].items(), key=lambda p: p[0])],
+                'tables': [
+                    (project, summary_tables(bes[be]['projects'][project]['history']['summary_table']))
+                    for project in sorted(cfg['backends'][be]['projects'], key=str.lower)
+                ],
+            }
+            for be in backends
+        ],
+        'columns': [(column.capitalize(), len(tasks)) for column, tasks in sorted(total['columns'].items())],
+        'anti': {
+            'total': total['anti'].get('total'),
+            'patterns': [
+                (pattern, [task.id for task in tasks])
+                for pattern, tasks in sorted(total['anti'].get('patterns', {}).items())
+            ],
+        },
+        'group': {
+            'count': group.get('count'),
+            'assigned': len(group['assigned']),
+            'antipatterns': len(group.get('antipatterns', [])),
+        },
+        'users': users,
+        'totals': summary_tables(total['projects']['history']['summary_table']),
+    }
+
+
+def render(cfg, model, **globals):
+    """ render the report a piece at a time
+    :param cfg: dict of full config
+    :param model: dict as returned by build
+    :return: generator of str
+    """
+    template = environment(cfg['templates'], cfg.get('template_cache')).get_template('body.html')
+    return template.generate(view=model, **globals)